@@ -2,16 +2,58 @@
 '''指定残基名称，残基所包含的原子数量，要添加的原子在残基中的索引，然后在指定ndx文件中添加一个新的组，组内包含这些指定的残基内的原子.
 
 add_group_to_ndx.py new_group_name res_name atoms_num_of_res index_of_atoms num_mols ndx_file
+add_group_to_ndx.py --batch spec_file ndx_file
 
 残基名称必须是ndx文件的一个group.
 原子数量为整数
 索引如果包含多个原子请用空格分开并用引号包围
+批量添加时spec_file每行为一个组: new_group_name res_name atoms_num_of_res "index_of_atoms" num_mols，
+空行和以#开头的行被忽略，所有组添加完成后只写一次ndx文件.
 '''
 
 import sys
 import os
+import shlex
 from gromacs.fileformats import ndx
 
+
+def read_specs(spec_file):
+    '''读取批量添加的spec文件，返回 (new_group_name, res_name, atoms_num_of_res, atoms, num_mols) 的list.'''
+    specs = []
+    with open(spec_file) as f:
+        for linenum, line in enumerate(f, 1):
+            if len(line.strip()) == 0 or line.strip().startswith('#'):
+                continue
+            try:
+                group, res, num, indices_str, num_mols = shlex.split(line)
+                specs.append((group, res, int(num), [int(i) for i in indices_str.split()], int(num_mols)))
+            except ValueError as err:
+                print('%s:%d: invalid spec (%s): %s' % (spec_file, linenum, err, line.strip()))
+                print(__doc__)
+                exit(1)
+    return specs
+
+
+if len(sys.argv) == 4 and sys.argv[1] == '--batch':
+    spec_file, ndx_file = sys.argv[2:4]
+    for f in (spec_file, ndx_file):
+        if not os.path.exists(f):
+            print(f, 'does not exist.')
+            print(__doc__)
+            exit(1)
+    specs = read_specs(spec_file)
+    ndx_exa = ndx.NDX(ndx_file)
+    for group, res, num, indices, num_mols in specs:
+        if not res in ndx_exa:
+            print('res_name', res, 'is not a group of', ndx_file)
+            exit(1)
+        if len(group) <= 1:
+            print("The length of group name must bigger than 1.")
+            exit(1)
+    for group in ndx_exa.add_groups_of_atoms_in_res(specs):
+        print('Added', group, 'including', len(ndx_exa[group]), 'atoms successfully.')
+    exit(0)
+
 if len(sys.argv) != 7:
     print(__doc__)
     exit(1)
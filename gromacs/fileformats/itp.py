@@ -22,18 +22,89 @@ import re
 import numpy
 import gromacs.utilities as utilities
 from .preprocessor import Preprocessor
-from collections import OrderedDict, Iterable
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterable, Mapping
 import logging
 
 
+class SectionList(object):
+    """Sections in file order with a lookup by name.
+
+    Sections with the same name (e.g. a ``[ dihedrals ]`` section for proper
+    and one for improper dihedrals) are kept separately. ``sections[name]``
+    is the last section called *name* and :meth:`getall` returns all of them;
+    iterating, :meth:`keys`, :meth:`values` and :meth:`items` follow the file
+    order and include every section.
+    """
+    def __init__(self):
+        self._sections = []   # [(name, section), ...]
+        self._index = {}      # name -> positions in _sections
+
+    def append(self, name, section):
+        """Add *section* called *name* after all sections."""
+        self._index.setdefault(name, []).append(len(self._sections))
+        self._sections.append((name, section))
+
+    def getall(self, name):
+        """Return all sections called *name*, in file order."""
+        return [self._sections[i][1] for i in self._index.get(name, [])]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __getitem__(self, name):
+        return self._sections[self._index[name][-1]][1]
+
+    def __setitem__(self, name, section):
+        """Replace the last section called *name* or add it."""
+        if name in self._index:
+            self._sections[self._index[name][-1]] = (name, section)
+        else:
+            self.append(name, section)
+
+    def __delitem__(self, name):
+        """Delete all sections called *name*."""
+        if name not in self._index:
+            raise KeyError(name)
+        self._sections = [(n, section) for n, section in self._sections if n != name]
+        self._index = {}
+        for i, (n, section) in enumerate(self._sections):
+            self._index.setdefault(n, []).append(i)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [name for name, section in self._sections]
+
+    def values(self):
+        return [section for name, section in self._sections]
+
+    def items(self):
+        return list(self._sections)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._sections)
+
+
 class ITPSection(object):
     """Class to parse and store ITP data.
 
     - :attr:`data` contains the data of the section
     - :attr:`sections` holds the sub-parsers (including their own :attr:`data`;
-      this :class:`OrderedDict` mirrors the parse tree.
+      this :class:`SectionList` mirrors the parse tree.
 
-      Note that sections at the same level are merged.
+      Sections with the same name at the same level are kept separately,
+      in file order.
 
     - :attr:`parsers` contains a dict of the all the parser classes
       (keyed by section name) that are included in *this* section;
@@ -57,7 +128,7 @@ class ITPSection(object):
     def __init__(self, parent, **kwargs):
         self.parent = parent        # parent section
         self.logger = parent.logger
-        self.sections = OrderedDict()
+        self.sections = SectionList()
         self.__data = kwargs.pop("data", [])
         self.comments = kwargs.pop("comments", [])
         self.parsers = {}
@@ -70,6 +141,10 @@ class ITPSection(object):
         # incomplete, override!
         return "[ %s ]" % self.name
 
+    def section_chunks(self):
+        """Generator of the text of :meth:`section` in pieces, for writing."""
+        yield self.section()
+
     def __len__(self):
         try:
             return len(self.data)
@@ -107,12 +182,7 @@ class ITPSection(object):
 
             m = self.SECTION.match(line)
             if m:
-                if current_section == m.group('name'):
-                    self.logger.info("Merging [ %(current_section)s ] sections!", vars())
-                    # Note: If we stored sections in a list instead of an OrderedDict then
-                    #       we could keep them separate and don't have to merge here.
-                    continue
-                # switch to new section and parser
+                # switch to new section and parser (also for a repeated section)
                 current_section = m.group('name')
                 try:
                     parser = self.parsers[current_section](self)
@@ -124,7 +194,7 @@ class ITPSection(object):
                     #       the section.
                     stream.unread()
                     break
-                self.sections[current_section] = parser
+                self.sections.append(current_section, parser)
                 self.logger.debug("Parsing section %(current_section)r", vars())
 
                 parser.parse(stream)
@@ -178,16 +248,62 @@ class ITPdata(ITPSection):
     def __init__(self, *args, **kwargs):
         super(ITPdata, self).__init__(*args, **kwargs)
         self.__records = []   # [((atomnr, atomtype, ...), comment), ...]
+        self.__numcols = []   # number of columns of each record
         self.__data = None    # recarray
 
     def _create_recarray(self):
         """Build a recarray from parsed data."""
-        # build empty record array and fill line by line to accomodate
-        # lines with variable number of entries
-        numcols = [len(record) for record, comment in self.__records]
+        # lines with variable number of entries: records with the same number
+        # of columns are converted column by column, missing columns are
+        # filled with None (nan, 'None' or None, depending on the type)
+        records = self.__records
+        numcols = numpy.array(self.__numcols, dtype=int)
         nmax = numpy.max(numcols) if len(numcols) > 0 else 0
         dtype = self.dtypes[:nmax] + [("comment", "U128")]
-        a = numpy.recarray((len(self.__records),), dtype=dtype)
+        a = numpy.recarray((len(records),), dtype=dtype)
+        if nmax > len(self.dtypes):
+            return self._fill_recarray(a, nmax)   # fails like the row by row assignment
+        try:
+            a["comment"] = [comment for record, comment in records]
+            for ncol in numpy.flatnonzero(numpy.bincount(numcols)):
+                rows = numpy.flatnonzero(numcols == ncol)
+                group = [records[i][0] for i in rows.tolist()]
+                for j, (name, type_) in enumerate(self.dtypes[:ncol]):
+                    a[name][rows] = self._convert_column([record[j] for record in group], type_)
+                for name, type_ in self.dtypes[ncol:nmax]:
+                    a[name][rows] = self._convert_column((None,), type_)
+        except (ValueError, TypeError, OverflowError):
+            # whatever the bulk conversion does not understand
+            return self._fill_recarray(a, nmax)
+        return a
+
+    @staticmethod
+    def _convert_column(column, type_):
+        """Convert the strings (or None) of one column to an array of *type_*."""
+        kind = numpy.dtype(type_).kind
+        if kind == 'O':
+            values = numpy.empty(len(column), dtype=object)
+            values[:] = column
+            return values
+        if column[0] is None:
+            if kind == 'f':
+                return numpy.nan
+            if kind == 'U':
+                return 'None'
+            raise TypeError("Missing value in column of type %s." % type_)
+        if kind in 'iuf':
+            # one C-level parse of the whole column
+            values = numpy.fromstring(" ".join(column), dtype=int if kind in 'iu' else float, sep=' ')
+            if len(values) != len(column):
+                raise ValueError("Column of type %s does not contain one number per record." % type_)
+            if kind in 'iu' and len(values) and (values.min() < numpy.iinfo(type_).min or
+                                                 values.max() > numpy.iinfo(type_).max):
+                raise OverflowError("Column values out of bounds for %s." % type_)
+            return values.astype(type_)
+        return numpy.array(column, dtype=type_)
+
+    def _fill_recarray(self, a, nmax):
+        """Fill the recarray *a* record by record."""
         for i, (record, comment) in enumerate(self._canonical_records(nmax=nmax)):
             a[i] = record + (comment,)
         return a
@@ -235,22 +351,36 @@ class ITPdata(ITPSection):
             comment = m.group('comment') or ""
             record = m.group('data').split()
             self.__records.append((record, comment))
+            self.__numcols.append(len(record))
             return
 
         self.logger.warn("[%s] not parsing line: %r", self.name, line)
 
+    @staticmethod
+    def _is_NONE(x):
+        if x is None:
+            return True
+        try:
+            return numpy.isnan(x)
+        except TypeError:
+            pass
+        return False
+
     def _clean_records(self):
         """Generator returning data records with ``None`` or ``nan`` entries stripped,"""
-        def is_NONE(x):
-            if x is None:
-                return True
-            try:
-                return numpy.isnan(x)
-            except TypeError:
-                pass
-            return False
         for rec in self.data:
-            yield tuple([x for x in rec if not is_NONE(x)])
+            yield tuple([x for x in rec if not self._is_NONE(x)])
+
+    def _missing(self, column):
+        """Boolean array of the ``None`` or ``nan`` entries of a *column* of the data."""
+        if column.dtype.kind in 'fcmM':
+            return numpy.isnan(column)
+        if column.dtype.kind == 'O':
+            return numpy.fromiter((bool(self._is_NONE(x)) for x in column), dtype=bool, count=len(column))
+        return numpy.zeros(len(column), dtype=bool)
+
+    #: number of records formatted at once by :meth:`section_chunks`
+    chunkrows = 8192
 
     def section(self):
         """Return a string of the section data in ITP format.
@@ -259,9 +389,42 @@ class ITPdata(ITPSection):
         accordance with Gromacs ITP parsing rules, data columns can only be
         ommitted from the right.
         """
-        lines = ["[ %s ]" % self.name]          # start with section header
-        lines.append(self.column_comment)       # add fixed column descriptors
+        return "".join(self.section_chunks())
 
+    def section_chunks(self):
+        """Generator of the text of :meth:`section` in chunks of :attr:`chunkrows` records.
+
+        The ``None`` or ``nan`` entries are found column by column, which
+        gives the number of columns of each record, and each chunk is
+        formatted with a single ``%`` operation from the line templates for
+        these numbers of columns.
+        """
+        yield "[ %s ]\n%s\n" % (self.name, self.column_comment)
+        data = self.data
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.array(list(data))      # e.g. a sorted list of records
+        if data.dtype.names is None or data.dtype[-1].kind not in 'US':
+            for line in self._section_lines():
+                yield line + "\n"
+            return
+        fields, comment = data.dtype.names[:-1], data.dtype.names[-1]   # comment is always last field
+        templates = numpy.array([" ".join(self.fmt[:numcols]) + tail
+                                 for numcols in range(len(fields) + 1) for tail in ("", " ; %s")], dtype=object)
+        for start in range(0, len(data), self.chunkrows):
+            block = data[start:start + self.chunkrows]
+            present = numpy.empty((len(block), len(fields) + 1), dtype=bool)
+            values = numpy.empty(present.shape, dtype=object)
+            for j, name in enumerate(fields):
+                present[:, j] = ~self._missing(block[name])
+                values[:, j] = block[name]
+            present[:, -1] = numpy.char.str_len(block[comment]) > 0     # add non-empty comment
+            values[:, -1] = block[comment]
+            numcols = present[:, :-1].sum(axis=1)
+            lines = "\n".join(templates[2 * numcols + present[:, -1]].tolist()) + "\n"
+            yield lines % tuple(values[present].tolist())
+
+    def _section_lines(self):
+        """Generator of the formatted data lines, record by record."""
         for rec in self._clean_records():
             numcols = len(rec) - 1              # subtract 1 because comment is always last field in record
             fmt = " ".join(self.fmt[:numcols])  # fill columns left-to-right
@@ -270,9 +433,7 @@ class ITPdata(ITPSection):
                 line = fmt % tuple(rec)
             else:                               # line without trailing comment
                 line = fmt % tuple(rec)[:-1]
-            lines.append(line)
-
-        return "\n".join(lines) + "\n"
+            yield line
 
 
 class Header(ITPSection):
@@ -347,7 +508,8 @@ class Moleculetype(ITPSection):
         2. changes the resname in the whole ``[atoms]`` section
         """
         self.data['name'] = molname
-        self.sections['atoms'].set_resname(molname)
+        for atoms in self.sections.getall('atoms'):
+            atoms.set_resname(molname)
 
     def section(self):
         # currently without user comments
@@ -483,17 +645,13 @@ class Dihedrals(ITPdata):
           2    1    3    4      3 ; HA-CA-CA-HA # aromatic ring (X-CA-CA-X generic proper dihedral)
           2    1    3    5      3 ; HA-CA-CA-CA # aromatic ring (X-CA-CA-X generic proper dihedral)
 
-    .. Note:: Multiple *adjacent* dihedral sections are currently merged into a
-              single dihedral section. This means that if you separated proper
-              and improper dihedrals into two different sections then they will
-              now appear one after another under a single ``[ dihedrals ]``
-              section. If two dihedral sections are separated by another
-              section then the last one overwrites the previous one.
+    .. Note:: Multiple dihedral sections (e.g. propers and impropers) are
+              kept separately: ``moleculetype.dihedrals`` is the last one and
+              ``moleculetype.sections.getall('dihedrals')`` returns all of
+              them in file order.
 
     .. versionadded:: 0.2.5
     """
-    # NOTE: XXX this can appear multiple times (propers and impropers!)
-
     name = "dihedrals"
     #: :class:`numpy.dtype` columns for the data
     dtypes = [("ai", "i4"), ("aj", "i4"), ("ak", "i4"), ("al", "i4"), ("func", "i4"),
@@ -582,15 +740,21 @@ class ITP(utilities.FileUtils):
     The top-level section is called *"header"* and simply contains all
     comment lines before the first real parsed section.
 
-    .. Warning::
+    Files with several molecule types (e.g. force field libraries) are best
+    accessed through :attr:`ITP.molecules`, which only indexes the
+    ``[ moleculetype ]`` blocks of the file and parses a molecule when it is
+    first used ::
+
+        itp = ITP('ions.itp', lazy=True)   # no parsing yet
+        itp.molecules['NA'].atoms.data
 
-       Not all section types are implemented. There can only be a single type
-       of section at each level of the hierarchy.
+    .. Warning::
 
-       Only a single ``[moleculetype]`` is currently supported.
+       Not all section types are implemented.
 
-       Subsequent ``[dihedrals]`` sections are merged but if another section
-       intersperses two ``[dihedral]`` sections then the first one is lost.
+       Sections with the same name are kept separately (see
+       :class:`SectionList`); attribute access such as
+       ``itp.header.moleculetype`` returns the last one of a name.
 
        Comments are stripped except at the beginning of the file and at the end
        of data lines.
@@ -603,12 +767,14 @@ class ITP(utilities.FileUtils):
     default_extension = "itp"
     logger = logging.getLogger('gromacs.formats.ITP')
 
-    def __init__(self, filename=None, **kwargs):
+    def __init__(self, filename=None, lazy=False, **kwargs):
         """Initialize ITP structure.
 
         :Arguments:
           *filename*
               read from mdp file
+          *lazy*
+              do not parse the file, only :attr:`molecules` can be used
           *kwargs*
               ``#define`` *VAR*  variables that are used at the pre-processing
               stage of the itp file, e.g. *POSRES* ``= True`` will activate a
@@ -624,15 +790,28 @@ class ITP(utilities.FileUtils):
         super(ITP, self).__init__(**kwargs)
 
         self.commentchar = ';'
-        self.sections = OrderedDict()
+        self.sections = SectionList()
         self.parsers = {
             'header': Header,
             'dummy': Dummy,
         }
+        self._molecules = None
 
         if not filename is None:
             self._init_filename(filename)
-            self.read(filename)
+            if not lazy:
+                self.read(filename)
+
+    @property
+    def molecules(self):
+        """:class:`MoleculeIndex` of all ``[ moleculetype ]`` blocks, by name.
+
+        The index is built with a single scan of the file; the sections of a
+        molecule are parsed when it is first accessed.
+        """
+        if self._molecules is None:
+            self._molecules = MoleculeIndex(self)
+        return self._molecules
 
     def contains_preprocessor_constructs(self):
         """Check if file makes use of any preprocessor constructs.
@@ -756,9 +935,18 @@ class ITP(utilities.FileUtils):
             return values
 
     def write(self, filename):
-        """Write ITP file to *filename*"""
+        """Write ITP file to *filename*
+
+        The sections are written one after another in chunks (see
+        :meth:`ITPdata.section_chunks`) instead of building the whole file in
+        memory; the output is the same as ``str(self)``.
+        """
         with open(filename, "w") as itp:
-            itp.write(str(self))
+            for i, section in enumerate(self.walk_sections(lambda name, section: section)):
+                if i > 0:
+                    itp.write("\n")
+                for chunk in section.section_chunks():
+                    itp.write(chunk)
 
     def __getattribute__(self, name):
         try:
@@ -775,6 +963,133 @@ class ITP(utilities.FileUtils):
         return "\n".join(self.walk_sections())
 
 
+class MoleculeIndex(Mapping):
+    """Index of the ``[ moleculetype ]`` blocks of an ITP file.
+
+    :attr:`offsets` holds the byte range of each block (from the line after
+    the ``[ moleculetype ]`` header up to the next one) by molecule name, in
+    file order. ``index[name]`` parses the block into a :class:`Moleculetype`
+    on first access and keeps it. If a molecule name occurs more than once,
+    the last block is used. Sections that :class:`Moleculetype` does not know
+    (e.g. ``[ settles ]``) are kept as :class:`Dummy`.
+
+    The index is built from the raw bytes of the file. Preprocessor
+    directives are evaluated as in :class:`~gromacs.fileformats.top.TOP`
+    with the defines of the :class:`ITP`: the index only follows
+    ``#define``, ``#undef`` and the conditionals, so that headers in inactive
+    branches are skipped, and remembers their state at each block. The lines
+    of a block are evaluated when it is parsed, with the macros (variables
+    defined with a value) substituted. ``#include`` is not supported and
+    ignored.
+    """
+    MOLECULETYPE = re.compile(br"^[ \t]*\[[ \t]*moleculetype[ \t]*\][^\n]*\n?", re.MULTILINE)
+    DIRECTIVE = re.compile(br"^[ \t]*#[^\n]*", re.MULTILINE)
+
+    def __init__(self, itp):
+        from .top import Conditions, TopologyFile
+
+        self.itp = itp
+        self.filename = itp.real_filename
+        self.offsets = OrderedDict()   # name -> (start, end)
+        self._states = {}              # name -> (linenum, defines, branches) at the start of the block
+        self._molecules = {}
+
+        with open(self.filename, 'rb') as f:
+            content = f.read()
+
+        # only lines containing 'moleculetype' can be headers; searching the bytes
+        # is much faster than matching the regular expression at each line
+        events = []
+        pos = content.find(b'moleculetype')
+        while pos != -1:
+            m = self.MOLECULETYPE.match(content, content.rfind(b'\n', 0, pos) + 1)
+            if m:
+                events.append((m.start(), m))
+            pos = content.find(b'moleculetype', pos + 1)
+        if b'#' in content:
+            events.extend((m.start(), m) for m in self.DIRECTIVE.finditer(content))
+            events.sort(key=lambda event: event[0])
+
+        defines = dict((var, '' if value is True else str(value)) for var, value in itp.defines.items() if value)
+        conditions = Conditions(defines, self.filename)
+        headers = []                   # (match, linenum, defines, branches) of the active headers
+        linenum, last = 1, 0
+        for offset, m in events:
+            linenum += content.count(b'\n', last, offset)
+            last = offset
+            if m.re is self.DIRECTIVE:
+                kind, value, _ = TopologyFile.directive(m.group().strip().decode(), self.filename, linenum)
+                if conditions.evaluate(kind, value, linenum):
+                    self.itp.logger.warning("%s:%d: ignoring #include %s", self.filename, linenum, value)
+            elif conditions.active:
+                headers.append((m, linenum + 1, dict(conditions.defines), list(conditions.branches)))
+        conditions.close()
+
+        ends = [m.start() for m, linenum, defines, branches in headers[1:]] + [len(content)]
+        for (m, linenum, defines, branches), end in zip(headers, ends):
+            name = self._molecule_name(content, m.end(), end)
+            self.offsets.pop(name, None)
+            self.offsets[name] = (m.end(), end)
+            self._states[name] = (linenum, defines, branches)
+
+    @staticmethod
+    def _molecule_name(content, start, end):
+        """Return the name in the first data line of the block *content[start:end]*."""
+        while start < end:
+            eol = content.find(b'\n', start, end)
+            eol = end if eol == -1 else eol
+            line = content[start:eol].split(b';')[0].strip()
+            if line.startswith(b'['):
+                break
+            if line and not line.startswith(b'#'):
+                return line.split()[0].decode()
+            start = eol + 1
+        raise ValueError("[ moleculetype ] at byte %d without a molecule name." % start)
+
+    def _block(self, name):
+        start, end = self.offsets[name]
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def _lines(self, name):
+        """Generator of the lines of the block of *name* in the active branches, with the macros substituted."""
+        from .top import Conditions, TopologyFile, expand
+
+        firstline, defines, branches = self._states[name]
+        conditions = Conditions(dict(defines), self.filename, branches)
+        macros = dict((var, value) for var, value in defines.items() if value)
+        for linenum, line in enumerate(self._block(name).decode().splitlines(), firstline):
+            if line.lstrip().startswith('#'):
+                kind, value, _ = TopologyFile.directive(line.strip(), self.filename, linenum)
+                if conditions.evaluate(kind, value, linenum):
+                    self.itp.logger.warning("%s:%d: ignoring #include %s", self.filename, linenum, value)
+                macros = dict((var, value) for var, value in conditions.defines.items() if value)
+            elif conditions.active:
+                yield expand(line, macros) if macros else line
+
+    def __getitem__(self, name):
+        if name not in self._molecules:
+            if name not in self.offsets:
+                raise KeyError("No [ moleculetype ] %r in %s." % (name, self.filename))
+            molecule = Moleculetype(self.itp)
+            # the block holds only this molecule: keep unknown sections instead of stopping there
+            molecule.parsers = defaultdict(lambda: Dummy, molecule.parsers)
+            lines = self._lines(name)
+            molecule.parse(OneLineBuffer(lines.__next__))
+            self._molecules[name] = molecule
+        return self._molecules[name]
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+
 class OneLineBuffer(object):
     """Wrapper around anything with a ``next()`` method, to provide an ``unread()``.
 
@@ -24,18 +24,44 @@ access to the individual groups.
    :members:
 
 .. autoclass:: IndexSet
+
+.. autoclass:: IndexRanges
+   :members: toarray
+
+.. autoclass:: RangeSet
+   :members: union, intersection, difference
+
+.. autoclass:: ReverseIndex
+   :members:
+
+Binary index files
+------------------
+
+:meth:`NDX.write_binary` stores an index in a compact binary container
+(suffix ``.ndxb``) next to the text file: a header table with the name, data
+offset, length and dtype of each group followed by the groups as packed int32
+arrays. :meth:`NDX.read_binary` memory-maps the container and reads only the
+requested groups. Use :meth:`NDX.write` to convert back to the text format
+for the Gromacs tools.
 """
 
+import logging
+import mmap
+import numbers
+import os
 import re
-import operator
+import struct
 
 import numpy
+from numpy.lib.mixins import NDArrayOperatorsMixin
 
 #from gromacs import ParseError, AutoCorrectionWarning
 import gromacs.utilities as utilities
 from collections import OrderedDict as odict
 #from gromacs.odict import odict
 
+logger = logging.getLogger('gromacs.fileformats.ndx')
+
 
 class NDX(odict, utilities.FileUtils):
     """Gromacs index file.
@@ -77,64 +103,364 @@ class NDX(odict, utilities.FileUtils):
         ndx['chi1'] = [2, 7, 8, 10]
         ndx.write()
 
+    Index files can contain several groups with the same name (e.g. from
+    :program:`make_ndx`). Every occurrence is kept, in file order, and
+    written back by :meth:`write`; ``ndx[name]`` is the last one and
+    :meth:`get_all` returns all of them.
+
+    With :attr:`min_run` set (e.g. ``NDX.min_run = 16``), groups that
+    consist of long runs of consecutive atom numbers (such as ``System`` or
+    ``SOL``) are stored as :class:`IndexRanges`, which behave like a
+    read-only array of the atom numbers but only keep the first and last
+    atom of each run. This is opt-in: the index does not choose the run
+    storage by itself, and by default (:attr:`min_run` = ``None``) every
+    group is a plain, changeable array.
+
+    With ``NDX(filename, lazy=True)`` the file is only scanned for its
+    ``[ name ]`` headers and a group is parsed when it is first accessed;
+    :attr:`groups`, :attr:`sizes` and :attr:`ndxlist` do not parse any group.
+
     """
     default_extension = "ndx"
 
     # match:  [ index_groupname ]
     SECTION = re.compile("""\s*\[\s*(?P<name>\S.*\S)\s*\]\s*""")
+    # match:  [ index_groupname ] as a whole line of the file content
+    SECTIONS = re.compile(br"^[ \t]*\[[ \t]*(?P<name>\S.*\S)[ \t]*\][ \t]*\r?$", re.MULTILINE)
 
     #: standard ndx file format: 15 columns
     ncol = 15
     #: standard ndx file format: '%6d'
     format = '%6d'
 
-    def __init__(self, filename=None, **kwargs):
+    #: groups whose runs of consecutive atom numbers are at least this long
+    #: on average are stored as :class:`IndexRanges` (``None``: never)
+    min_run = None
+
+    #: magic bytes and version of the binary index format
+    BINARY_MAGIC = b'NDXB'
+    BINARY_VERSION = 1
+    binary_extension = "ndxb"
+
+    def __init__(self, filename=None, lazy=False, **kwargs):
+        # [[name, atomnumbers, (start, end) in the source file or None], ...] of
+        # all groups, including duplicates
+        self._store = []
+        self._positions = {}  # name -> positions of its occurrences in _store
+        self._source = None   # (path, size, mtime, number of sections) of the file read
+        self._content = None  # memory map of the file read lazily
         super(NDX, self).__init__(**kwargs)  # can use kwargs to set dict! (but no sanity checks!)
 
-        if not filename is None:
-            self.read(filename)
+        if not filename is None and filename.endswith('.' + self.binary_extension):
+            self.read_binary(filename, lazy=lazy)
+        elif not filename is None:
+            self.read(filename, lazy=lazy)
             self._init_filename(filename)
 
     def _init_filename(self, filename):
         '''Convert filename to real_filename if it doesn't have suffix.'''
         self.real_filename = filename + '.' + self.default_extension if filename[-3:] != self.default_extension else filename
 
-    def read(self, filename=None):
-        """Read and parse index file *filename*."""
+    @classmethod
+    def _scan_sections(cls, content):
+        """Find the sections of the index file *content* (bytes or mmap).
+
+        :Returns: list of ``(name, start, body, end)``, where *start* is the
+                  offset of the ``[ name ]`` line, *body* the offset of the
+                  first line after it and *end* the offset of the next section
+                  (or the end of the content).
+        """
+        # only lines with a '[' can be sections; searching the bytes is much
+        # faster than matching the regular expression at each line
+        matches = []
+        pos = content.find(b'[')
+        while pos != -1:
+            m = cls.SECTIONS.match(content, content.rfind(b'\n', 0, pos) + 1)
+            if m:
+                matches.append(m)
+                pos = m.end()
+            pos = content.find(b'[', pos + 1)
+        ends = [m.start() for m in matches[1:]] + [len(content)]
+        return [(m.group('name').decode(), m.start(), m.end() + 1, end) for m, end in zip(matches, ends)]
+
+    @staticmethod
+    def _parse_body(body):
+        """Convert the atom numbers of a section body (bytes) in a single pass."""
+        if not body.strip():
+            return numpy.zeros(0, dtype=int)
+        return numpy.fromstring(body, dtype=int, sep=' ')
+
+    @staticmethod
+    def _count_body(content, body, end):
+        """Count the atom numbers in ``content[body:end]`` without converting them."""
+        if end <= body:
+            return 0
+        chars = numpy.frombuffer(content, dtype=numpy.uint8, count=end - body, offset=body)
+        token = chars > 32
+        return int(token[0]) + int(numpy.count_nonzero(token[1:] & ~token[:-1]))
+
+    def read(self, filename=None, lazy=False):
+        """Read and parse index file *filename*.
+
+        The section boundaries are located with a single regular expression
+        search over the whole file and the body of each group is converted to
+        integers in one :func:`numpy.fromstring` call.
+
+        With *lazy* the file is memory-mapped and only the section boundaries
+        are read; each group is parsed when it is accessed for the first time.
+        """
         self._init_filename(filename)
 
-        data = odict()
-        # Bug fix, The ndx has reduplicated section, so the groups can't be stored in dict.
-        self.all_groups = []
-        with open(self.real_filename) as ndx:
-            current_section = None
-            for line in ndx:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                m = self.SECTION.match(line)
-                if m:
-                    current_section = m.group('name')
-                    self.all_groups.append(current_section)
-                    data[current_section] = []  # can fail if name not legal python key
-                    continue
-                if not current_section is None:
-                    data[current_section].extend(map(int, line.split()))
-
-        super(NDX, self).update(odict([(name, self._transform(atomnumbers)) for name, atomnumbers in data.items()]))
-
-    def write(self, filename=None, ncol=ncol, format=format):
-        """Write index file to *filename* (or overwrite the file that the index was read from)"""
-        with open(self.filename(filename, ext='ndx'), 'w') as ndx:
-            for name in self:
-                atomnumbers = self._getarray(name)  # allows overriding
+        with open(self.real_filename, 'rb') as ndx:
+            if lazy and os.fstat(ndx.fileno()).st_size:
+                content = self._content = mmap.mmap(ndx.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                content = ndx.read()
+                lazy = False
+        # Bug fix, The ndx has reduplicated section, so the groups are also kept in a list.
+        read = set()
+        sections = self._scan_sections(content)
+        for name, start, body, end in sections:
+            if lazy:
+                # stored as is, transformed when parsed by _load()
+                value = _LazyGroup(body, end)
+                self._positions.setdefault(name, []).append(len(self._store))
+                self._store.append([name, value, None])
+                super(NDX, self).__setitem__(name, value)
+            elif name in read:
+                self.append(name, self._parse_body(content[body:end]))
+            else:
+                self[name] = self._parse_body(content[body:end])
+                read.add(name)
+            self._store[self._positions[name][-1]][2] = (start, end)
+        self._source = self._stat(self.real_filename) + (len(sections),)
+
+    def _load(self, i):
+        """Return the group at position *i* of the store, parsing it if it was read lazily."""
+        group = self._store[i]
+        if isinstance(group[1], _LazyGroup):
+            group[1] = self._transform(group[1].load(self._content))
+            if self._positions[group[0]][-1] == i:
+                super(NDX, self).__setitem__(group[0], group[1])
+        return group[1]
+
+    def _load_all(self):
+        """Parse all groups that were read lazily."""
+        for i in range(len(self._store)):
+            self._load(i)
+
+    def _size(self, i):
+        """Return the number of atoms of the group at position *i* of the store."""
+        value = self._store[i][1]
+        if isinstance(value, _LazyGroup):
+            return value.size(self._content)
+        return len(value)
+
+    @staticmethod
+    def _stat(filename):
+        st = os.stat(filename)
+        return (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+
+    #: number of rows formatted at once by :meth:`write`
+    chunkrows = 65536
+
+    def write(self, filename=None, ncol=None, format=None):
+        """Write index file to *filename* (or overwrite the file that the index was read from)
+
+        *ncol* and *format* default to :attr:`ncol` and :attr:`format`.
+        """
+        filename = self.filename(filename, ext='ndx')
+        self._load_all()
+        if self._source is not None and os.path.realpath(filename) == self._source[0]:
+            self._source = None   # the byte ranges of the file read are lost
+        with open(filename, 'w') as ndx:
+            for name, value, source in self._store:
+                atomnumbers = self._toarray(value)  # allows overriding
                 ndx.write('[ %s ]\n' % name)
-                for k in range(0, len(atomnumbers), ncol):
-                    line = atomnumbers[k: k + ncol].astype(int)   # nice formatting in ncol-blocks
-                    n = len(line)
-                    ndx.write((" ".join(n * [format]) + '\n') % tuple(line))
+                for chunk in self._format_group(atomnumbers, ncol or self.ncol, format or self.format):
+                    ndx.write(chunk)
                 ndx.write('\n')
 
+    def _format_section(self, name, value):
+        """Generator of the encoded chunks of the section of group *name*, as in :meth:`write`."""
+        yield ('[ %s ]\n' % name).encode()
+        for chunk in self._format_group(self._toarray(value), self.ncol, self.format):
+            yield chunk.encode()
+        yield b'\n'
+
+    def save(self, filename=None):
+        """Write the index to *filename* incrementally (default: the file it was read from).
+
+        Only what changed since :meth:`read` is formatted:
+
+        - if groups were only added and *filename* is the file read, just
+          their sections are appended to the file;
+        - otherwise the file is rewritten by a streaming copy in which the
+          unchanged groups are copied as byte ranges of the file read and
+          only new or replaced groups are formatted.
+
+        Falls back to :meth:`write` if the file read changed on disk
+        meanwhile. Groups must be replaced by assignment (``ndx[name] =
+        ...``) rather than modified in place to be written again.
+        """
+        target = os.path.realpath(self.filename(filename, ext='ndx') if filename else self.real_filename)
+        if self._source is None or not os.path.exists(self._source[0]) or \
+                self._stat(self._source[0]) != self._source[:3]:
+            self.write(target)
+            self._source = None
+            return
+        path, size, mtime, nsections = self._source
+        nread = len(self._store)
+        for i, (name, value, source) in enumerate(self._store):
+            if source is None:
+                nread = i
+                break
+        if target == path and nread == nsections and all(group[2] is None for group in self._store[nread:]):
+            self._append_sections(path, self._store[nread:])
+        else:
+            self._copy_sections(path, target)
+
+    def _append_sections(self, path, groups):
+        """Append the sections of the store entries *groups* to the file read."""
+        with open(path, 'ab') as ndx:
+            pos = ndx.tell()
+            if pos > 0:
+                with open(path, 'rb') as f:
+                    f.seek(pos - 1)
+                    if f.read(1) != b'\n':
+                        ndx.write(b'\n')
+                        pos += 1
+            for group in groups:
+                start = pos
+                for chunk in self._format_section(group[0], group[1]):
+                    ndx.write(chunk)
+                    pos += len(chunk)
+                group[2] = (start, pos)
+        self._source = self._stat(path) + (self._source[3] + len(groups),)
+
+    def _copy_sections(self, path, target):
+        """Write all groups to *target*, copying the unchanged sections from the file *path*."""
+        tmp = target + '.tmp' if target == path else target
+        with open(path, 'rb') as src, open(tmp, 'wb') as ndx:
+            content = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) if self._source[1] else b''
+            pos = 0
+            sources = []
+            for name, value, source in self._store:
+                start = pos
+                if source is not None:
+                    chunk = content[source[0]:source[1]]
+                    if not chunk.endswith(b'\n'):
+                        chunk += b'\n'
+                    ndx.write(chunk)
+                    pos += len(chunk)
+                else:
+                    for chunk in self._format_section(name, value):
+                        ndx.write(chunk)
+                        pos += len(chunk)
+                sources.append((start, pos))
+            if isinstance(content, mmap.mmap):
+                content.close()
+        if target == path:
+            os.replace(tmp, target)
+            for group, source in zip(self._store, sources):
+                group[2] = source
+            self._source = self._stat(target) + (len(sources),)
+
+    def write_binary(self, filename):
+        """Write the index to the binary container *filename* (usually ``*.ndxb``).
+
+        Layout (little endian): magic ``NDXB``, version and number of groups
+        (uint32); per group the name length (uint16), the UTF-8 name, the
+        offset and length of its data (uint64) and its dtype (4 bytes, e.g.
+        ``<i4``); then the data of the groups. Duplicate groups are kept.
+        """
+        self._load_all()
+        groups = [(name.encode(), numpy.asarray(self._toarray(value))) for name, value, source in self._store]
+        table_size = 12 + sum(2 + len(name) + 20 for name, atomnumbers in groups)
+        offset = table_size + (-table_size % 8)
+        table = [struct.pack('<4sII', self.BINARY_MAGIC, self.BINARY_VERSION, len(groups))]
+        datas = []
+        for name, atomnumbers in groups:
+            big = len(atomnumbers) and max(atomnumbers.max(), -atomnumbers.min()) >= 2 ** 31
+            data = atomnumbers.astype('<i8' if big else '<i4')
+            table.append(struct.pack('<H', len(name)) + name +
+                         struct.pack('<QQ4s', offset, len(data), data.dtype.str.encode().ljust(4)))
+            datas.append(data)
+            offset += data.nbytes
+        with open(filename, 'wb') as ndx:
+            ndx.write(b''.join(table).ljust(table_size + (-table_size % 8), b'\0'))
+            for data in datas:
+                ndx.write(data.tobytes())
+
+    @classmethod
+    def read_binary_table(cls, content):
+        """Read the header table of a binary index *content* (bytes or mmap).
+
+        :Returns: list of ``(name, offset, length, dtype)``
+        """
+        magic, version, ngroups = struct.unpack_from('<4sII', content, 0)
+        if magic != cls.BINARY_MAGIC or version != cls.BINARY_VERSION:
+            raise ValueError("Not a binary index file (version %d)." % cls.BINARY_VERSION)
+        table = []
+        pos = 12
+        for i in range(ngroups):
+            n, = struct.unpack_from('<H', content, pos)
+            name = bytes(content[pos + 2:pos + 2 + n]).decode()
+            offset, length, dtype = struct.unpack_from('<QQ4s', content, pos + 2 + n)
+            table.append((name, offset, length, dtype.strip().decode()))
+            pos += 2 + n + 20
+        return table
+
+    def read_binary(self, filename, groups=None, lazy=False):
+        """Read the binary index *filename*, see :meth:`write_binary`.
+
+        The file is memory-mapped and only the data of the groups named in
+        *groups* (all if ``None``) are read. With *lazy* only the header
+        table is read and each group is read when it is accessed for the
+        first time, as in :meth:`read`. The text filename for :meth:`write`
+        and friends is *filename* with the suffix ``.ndx``.
+        """
+        self.real_filename = filename[:-len(self.binary_extension)] + self.default_extension
+        with open(filename, 'rb') as f:
+            # the map is released when the last view of it is garbage collected
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if lazy:
+            self._content = content
+        read = set()
+        for name, offset, length, dtype in self.read_binary_table(content):
+            if groups is not None and name not in groups:
+                continue
+            if lazy:
+                value = _LazyBinaryGroup(offset, length, dtype)
+                self._positions.setdefault(name, []).append(len(self._store))
+                self._store.append([name, value, None])
+                super(NDX, self).__setitem__(name, value)
+                continue
+            atomnumbers = numpy.frombuffer(content, dtype=dtype, count=length, offset=offset)
+            if name in read:
+                self.append(name, atomnumbers)
+            else:
+                self[name] = atomnumbers
+                read.add(name)
+
+    def _format_group(self, atomnumbers, ncol, format):
+        """Generator of the formatted lines of a group in chunks of :attr:`chunkrows` rows.
+
+        Each chunk is formatted with a single ``%`` operation over all its
+        numbers, the lines are the same as formatting them one by one in
+        *ncol*-blocks.
+        """
+        atomnumbers = numpy.asarray(atomnumbers).astype(int)
+        row = " ".join(ncol * [format]) + '\n'
+        nfull = len(atomnumbers) // ncol
+        step = self.chunkrows * ncol
+        for k in range(0, nfull * ncol, step):
+            block = atomnumbers[k: min(k + step, nfull * ncol)]
+            yield (row * (len(block) // ncol)) % tuple(block.tolist())
+        rest = atomnumbers[nfull * ncol:]
+        if len(rest):
+            yield (" ".join(len(rest) * [format]) + '\n') % tuple(rest.tolist())
+
     def get(self, name):
         """Return index array for index group *name*."""
         return self[name]
@@ -147,6 +473,46 @@ class NDX(odict, utilities.FileUtils):
         """Return number of entries for group *name*."""
         return len(self[name])
 
+    def select(self, expression, atoms=None):
+        """Return the atoms of the make_ndx-style selection *expression*.
+
+        Example: ``ndx.select('SOL & !r 1-100 | a OW', atoms)``; see
+        :mod:`gromacs.fileformats.selection` for the syntax and *atoms*.
+
+        :Returns: :class:`IndexSet`
+        """
+        from .selection import select
+        return select(self, expression, atoms)
+
+    def reverse_index(self):
+        """Return the :class:`ReverseIndex` atom number -> groups of the index.
+
+        The index is built once over all groups and answers membership
+        queries without scanning the groups again; it does not follow later
+        changes of the groups.
+        """
+        return ReverseIndex(self)
+
+    def get_all(self, name):
+        """Return the index arrays of all groups called *name*, in file order."""
+        return [self._load(i) for i in self._positions[name]]
+
+    def append(self, name, value):
+        """Add group *name* after all groups, even if a group *name* exists.
+
+        The new group becomes ``ndx[name]``; an existing group of the same name
+        is kept as a duplicate.
+        """
+        value = self._transform(value)
+        self._positions.setdefault(name, []).append(len(self._store))
+        self._store.append([name, value, None])
+        super(NDX, self).__setitem__(name, value)
+
+    @property
+    def all_groups(self):
+        """Return a list of the names of all groups, including duplicates."""
+        return [group[0] for group in self._store]
+
     @property
     def groups(self):
         """Return a list of all groups."""
@@ -155,7 +521,7 @@ class NDX(odict, utilities.FileUtils):
     @property
     def sizes(self):
         """Return a dict with group names and number of entries,"""
-        return dict([(name, len(atomnumbers)) for name, atomnumbers in self.items()])
+        return dict([(name, self._size(i)) for i, name in enumerate(self.all_groups)])
 
     @property
     def ndxlist(self):
@@ -164,25 +530,74 @@ class NDX(odict, utilities.FileUtils):
         Format:
            [ {'name': group_name, 'natoms': number_atoms, 'nr':  # group_number}, ....]
         """
-        return [{'name': name, 'natoms': len(atomnumbers), 'nr': nr + 1} for
-                nr, (name, atomnumbers) in enumerate(self.items())]
+        return [{'name': name, 'natoms': self._size(nr), 'nr': nr + 1} for
+                nr, name in enumerate(self.all_groups)]
 
     def _getarray(self, name):
         """Helper getter that is used in write().
-        Override when using a _transform that stores something that
-        cannot be indexed, e.g. when using set()s.
+        Override :meth:`_toarray` when using a _transform that stores
+        something that cannot be indexed, e.g. when using set()s.
         """
-        return self[name]
+        return self._toarray(self[name])
+
+    def _toarray(self, value):
+        """Convert a stored group *value* to an index array."""
+        return value
 
     def _transform(self, v):
         """Transform input to the stored representation.
 
         Override eg with ``return set(v)`` for index lists as sets.
         """
-        return numpy.ravel(v).astype(int)
+        if isinstance(v, IndexRanges):
+            return v
+        return IndexRanges.encode(numpy.ravel(v).astype(int), self.min_run)
+
+    def __getitem__(self, k):
+        value = super(NDX, self).__getitem__(k)
+        if isinstance(value, _LazyGroup):
+            value = self._load(self._positions[k][-1])
+        return value
+
+    def values(self):
+        self._load_all()
+        return super(NDX, self).values()
+
+    def items(self):
+        self._load_all()
+        return super(NDX, self).items()
 
     def __setitem__(self, k, v):
-        super(NDX, self).__setitem__(k, self._transform(v))
+        if k not in self._positions:
+            self.append(k, v)
+            return
+        v = self._transform(v)
+        self._store[self._positions[k][-1]][1:] = [v, None]    # replaces the last duplicate
+        super(NDX, self).__setitem__(k, v)
+
+    def __delitem__(self, k):
+        """Delete all groups called *k*."""
+        super(NDX, self).__delitem__(k)
+        self._store = [group for group in self._store if group[0] != k]
+        self._positions = {}
+        for i, group in enumerate(self._store):
+            self._positions.setdefault(group[0], []).append(i)
+
+    def pop(self, k, *default):
+        if k not in self:
+            return super(NDX, self).pop(k, *default)
+        value = self[k]
+        del self[k]
+        return value
+
+    def popitem(self, last=True):
+        k = next(reversed(self)) if last else next(iter(self))
+        return k, self.pop(k)
+
+    def clear(self):
+        super(NDX, self).clear()
+        self._store = []
+        self._positions = {}
 
     def setdefault(*args, **kwargs):
         raise NotImplementedError
@@ -201,45 +616,493 @@ class NDX(odict, utilities.FileUtils):
             atoms: 包含原子在分子中的索引的list，索引从0开始
             num_mols: 所提取的分子数，默认按照顺序提取。如果为0或大于group中现在的分子数，则默认取全部分子。
         '''
-        if not res_name in self.all_groups:
-            return False
-        if not isinstance(atoms_num_of_res, int) and atoms_num_of_res < 1 and len(atoms) == 0:
+        if self._res_spec_error(new_group_name, res_name, atoms_num_of_res, atoms):
             return False
+        self[new_group_name] = self._atoms_in_res(res_name, atoms_num_of_res, atoms, num_mols)
+        self.save(self.real_filename)
+
+    def add_groups_of_atoms_in_res(self, specs, filename=None):
+        '''批量添加组，每个组与 add_group_of_atoms_in_res 相同，所有组添加完成后只写一次文件.
+
+        @Args:
+            specs: list，每一项为 (new_group_name, res_name, atoms_num_of_res, atoms[, num_mols])
+            filename: 保存的文件名，默认覆盖读取的文件
+        @Returns:
+            成功添加的组名称的list，无效的项不添加，并以warning记录到logger
+        '''
+        added = []
+        for spec in specs:
+            new_group_name, res_name, atoms_num_of_res, atoms = spec[:4]
+            error = self._res_spec_error(new_group_name, res_name, atoms_num_of_res, atoms)
+            if error:
+                logger.warning("Group %r not added: %s", new_group_name, error)
+                continue
+            num_mols = spec[4] if len(spec) > 4 else 0
+            self[new_group_name] = self._atoms_in_res(res_name, atoms_num_of_res, atoms, num_mols)
+            added.append(new_group_name)
+        self.save(filename or self.real_filename)
+        return added
+
+    def _res_spec_error(self, new_group_name, res_name, atoms_num_of_res, atoms):
+        '''检查 add_group_of_atoms_in_res 的参数，有效时返回None，否则返回错误信息.'''
+        if not res_name in self:
+            return "res_name %r is not a group of the index" % (res_name,)
+        if not isinstance(atoms_num_of_res, numbers.Integral) or atoms_num_of_res < 1:
+            return "atoms_num_of_res must be a positive integer, not %r" % (atoms_num_of_res,)
+        if len(atoms) == 0:
+            return "no atoms given"
         if len(new_group_name) <= 1:
-            return False
-        all_ress = []
+            return "the length of the group name must be bigger than 1"
+        return None
+
+    def _atoms_in_res(self, res_name, atoms_num_of_res, atoms, num_mols=0):
+        '''把残基组整形为 (分子数, atoms_num_of_res) 的数组，然后一次取出每个分子中索引为atoms的原子.'''
         total_mols = len(self[res_name]) // atoms_num_of_res
         mols = total_mols if num_mols == 0 or num_mols > total_mols else num_mols
-        for i in range(mols):
-            all_ress.append(self[res_name][i * atoms_num_of_res: (i + 1) * atoms_num_of_res])
-
-        self[new_group_name] = [int(k[i]) for k in all_ress for i in atoms]
-        self.write(self.real_filename)
+        ress = numpy.asarray(self._getarray(res_name))[:mols * atoms_num_of_res].reshape(mols, atoms_num_of_res)
+        return ress[:, numpy.asarray(atoms, dtype=int)].ravel()
 
     def del_all_groups_except_given(self, keeps, filename):
-        '''Delete all the groups except groups in keeps list and save to filename.'''
-        for i in self.keys():
+        '''Delete all the groups except groups in keeps list and save to filename.
+
+        The kept groups are copied from the file read without formatting them again, see :meth:`save`.
+        '''
+        for i in list(self.keys()):
             if i in keeps:
                 continue
             else:
                 del(self[i])
-        self.write(filename)
+        self.save(filename)
+
+
+class _LazyGroup(object):
+    """Placeholder for a group that is parsed on first access, see :meth:`NDX.read`."""
+    __slots__ = ('body', 'end')
+
+    def __init__(self, body, end):
+        self.body = body
+        self.end = end
+
+    def load(self, content):
+        """Return the atom numbers of the group in the file *content*."""
+        return NDX._parse_body(content[self.body:self.end])
+
+    def size(self, content):
+        """Return the number of atoms of the group without parsing it."""
+        return NDX._count_body(content, self.body, self.end)
+
+
+class _LazyBinaryGroup(_LazyGroup):
+    """Placeholder for a group of a binary index, see :meth:`NDX.read_binary`."""
+    __slots__ = ('offset', 'length', 'dtype')
+
+    def __init__(self, offset, length, dtype):
+        self.offset = offset
+        self.length = length
+        self.dtype = dtype
+
+    def load(self, content):
+        return numpy.frombuffer(content, dtype=self.dtype, count=self.length, offset=self.offset)
 
+    def size(self, content):
+        return self.length
+
+
+class IndexSet(numpy.ndarray):
+    """set which defines '+' as union (OR) and '-' as intersection  (AND).
+
+    The set is stored as a sorted 1D numpy array of unique atom numbers,
+    so that the set operations are vectorized (:func:`numpy.union1d` and
+    friends) and a group needs 8 bytes per atom. ``'|'`` and ``'&'`` are
+    the same as ``'+'`` and ``'-'``; use :meth:`difference` for atoms in
+    one set but not in another.
+
+    The comparisons, :func:`bool` and :meth:`issubset`, :meth:`issuperset`
+    and :meth:`isdisjoint` work as for a :class:`set` (``a <= b`` is the
+    subset test, ``a == b`` is ``True`` if both contain the same atoms).
+
+    .. Note::
+
+       Unlike a :class:`set`, an :class:`IndexSet` is an array: it can not
+       be changed in place with ``add()``, ``remove()`` or ``|=`` (which
+       builds a new set), and the NumPy functions work on the atom
+       numbers, e.g. ``numpy.add(s, 1)`` adds 1 to every atom number while
+       ``s + 1`` is the union with atom 1.
+    """
+    def __new__(cls, atomnumbers=()):
+        if isinstance(atomnumbers, IndexSet):
+            return atomnumbers
+        if isinstance(atomnumbers, (set, frozenset)):
+            atomnumbers = numpy.fromiter(atomnumbers, dtype=int, count=len(atomnumbers))
+        atomnumbers = numpy.sort(numpy.ravel(atomnumbers).astype(int))
+        # much faster than numpy.unique() for large integer arrays
+        unique = numpy.empty(len(atomnumbers), dtype=bool)
+        unique[:1] = True
+        numpy.not_equal(atomnumbers[1:], atomnumbers[:-1], out=unique[1:])
+        return atomnumbers[unique].view(cls)
+
+    @classmethod
+    def _sorted(cls, array):
+        """Wrap an array that is already sorted and unique."""
+        return numpy.asarray(array).view(cls)
+
+    def union(self, *others):
+        """Return the atoms in this set or in any of the *others*."""
+        return IndexSet(numpy.concatenate([self.view(numpy.ndarray)] + [IndexSet(x).view(numpy.ndarray) for x in others]))
+
+    def intersection(self, *others):
+        """Return the atoms in this set and in all of the *others*."""
+        result = self
+        for x in others:
+            result = numpy.intersect1d(result.view(numpy.ndarray), IndexSet(x).view(numpy.ndarray), assume_unique=True)
+        return self._sorted(result)
+
+    def difference(self, *others):
+        """Return the atoms in this set but in none of the *others*."""
+        result = self
+        for x in others:
+            result = numpy.setdiff1d(result.view(numpy.ndarray), IndexSet(x).view(numpy.ndarray), assume_unique=True)
+        return self._sorted(result)
+
+    def issubset(self, other):
+        """Return ``True`` if all atoms of this set are in *other*."""
+        other = IndexSet(other)
+        return len(self) <= len(other) and len(self.difference(other)) == 0
+
+    def issuperset(self, other):
+        """Return ``True`` if all atoms of *other* are in this set."""
+        return IndexSet(other).issubset(self)
+
+    def isdisjoint(self, other):
+        """Return ``True`` if this set has no atoms in common with *other*."""
+        return len(self.intersection(other)) == 0
+
+    def __contains__(self, atomnumber):
+        i = numpy.searchsorted(self, atomnumber)
+        return bool(i < len(self) and self.view(numpy.ndarray)[i] == atomnumber)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __eq__(self, other):
+        if not isinstance(other, (IndexSet, RangeSet, set, frozenset)):
+            return False
+        other = IndexSet(other)
+        return len(self) == len(other) and bool(numpy.array_equal(self.view(numpy.ndarray), other.view(numpy.ndarray)))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __le__(self, other):
+        return self.issubset(other)
+
+    def __lt__(self, other):
+        return len(self) < len(IndexSet(other)) and self.issubset(other)
+
+    def __ge__(self, other):
+        return self.issuperset(other)
+
+    def __gt__(self, other):
+        return len(self) > len(IndexSet(other)) and self.issuperset(other)
+
+    __hash__ = None
+
+    def __add__(self, x):
+        return self.union(x)
+
+    def __sub__(self, x):
+        return self.intersection(x)
+
+    __or__ = __add__
+    __and__ = __sub__
+
+
+class IndexRanges(NDArrayOperatorsMixin):
+    """Atom numbers stored as runs of consecutive numbers.
+
+    Run *i* consists of the atom numbers ``starts[i], ..., ends[i] - 1``, in
+    order, so any sequence of atom numbers can be represented exactly. The
+    object behaves like a read-only 1D array of the atom numbers
+    (:func:`len`, indexing, iteration, :func:`numpy.asarray`, arithmetic and
+    the other array methods), which is only materialized when it is needed.
+    Changing it in place raises :exc:`TypeError`; in-place operators such as
+    ``ndx[name] += 1`` return a new array.
+    """
+    __slots__ = ('starts', 'ends', '_offsets')
+
+    #: array methods that change the array in place
+    MUTATING = frozenset(['sort', 'fill', 'put', 'itemset', 'resize', 'partition', 'setfield', 'setflags'])
+
+    def __init__(self, starts, ends):
+        self.starts = numpy.asarray(starts, dtype=int)
+        self.ends = numpy.asarray(ends, dtype=int)
+        self._offsets = None    # position after the last atom of each run
+
+    @classmethod
+    def encode(cls, atomnumbers, min_run=None):
+        """Return the runs of the array *atomnumbers*.
+
+        If the runs are shorter than *min_run* on average (or *min_run* is
+        ``None``) *atomnumbers* is returned unchanged.
+        """
+        if min_run is None or len(atomnumbers) == 0:
+            return atomnumbers
+        array = numpy.asarray(atomnumbers)  # not an IndexSet, where '+' is the union
+        breaks = numpy.flatnonzero(numpy.diff(array) != 1) + 1
+        if len(array) < min_run * (len(breaks) + 1):
+            return atomnumbers
+        return cls(array[numpy.r_[0, breaks]], array[numpy.r_[breaks - 1, len(array) - 1]] + 1)
+
+    def toarray(self):
+        """Return the atom numbers as an array."""
+        counts = self.ends - self.starts
+        offsets = numpy.cumsum(counts) - counts
+        return numpy.repeat(self.starts - offsets, counts) + numpy.arange(counts.sum(), dtype=int)
+
+    def _run_offsets(self):
+        if self._offsets is None:
+            self._offsets = numpy.cumsum(self.ends - self.starts)
+        return self._offsets
+
+    def _slice(self, lo, hi):
+        """Return the atom numbers at the positions *lo* to *hi* - 1 from the runs that contain them."""
+        if hi <= lo:
+            return numpy.zeros(0, dtype=int)
+        offsets = self._run_offsets()
+        first, last = numpy.searchsorted(offsets, [lo, hi - 1], 'right')
+        runs = IndexRanges(self.starts[first:last + 1].copy(), self.ends[first:last + 1].copy())
+        runs.starts[0] += lo - (offsets[first] - (self.ends[first] - self.starts[first]))
+        runs.ends[-1] -= offsets[last] - hi
+        return runs.toarray()
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.toarray()
+        return array if dtype is None else array.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method == 'at' and isinstance(inputs[0], IndexRanges):
+            raise TypeError("%s is read-only, use numpy.array() for a changeable copy." % self.__class__.__name__)
+        inputs = [x.toarray() if isinstance(x, IndexRanges) else x for x in inputs]
+        if 'out' in kwargs:
+            # e.g. 'x += 1': write to a new array instead of the runs
+            out = tuple(x.toarray() if isinstance(x, IndexRanges) else x for x in kwargs['out'])
+            kwargs['out'] = out
+            getattr(ufunc, method)(*inputs, **kwargs)
+            return out[0] if len(out) == 1 else out
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # everything else of the array interface, e.g. reshape() or tolist()
+        if name.startswith('__') or name in IndexRanges.__slots__:
+            raise AttributeError(name)
+        if name in IndexRanges.MUTATING:
+            raise TypeError("%s is read-only, use numpy.array() for a changeable copy." % self.__class__.__name__)
+        return getattr(self.toarray(), name)
+
+    def __setitem__(self, key, value):
+        raise TypeError("%s is read-only, use numpy.array() for a changeable copy." % self.__class__.__name__)
+
+    def __len__(self):
+        return int(self._run_offsets()[-1]) if len(self.starts) else 0
+
+    def __iter__(self):
+        return iter(self.toarray())
+
+    def __getitem__(self, key):
+        # atoms and slices are looked up in the runs, anything else needs the array
+        if isinstance(key, (int, numpy.integer)):
+            offsets = self._run_offsets()
+            n = int(offsets[-1]) if len(offsets) else 0
+            if not -n <= key < n:
+                raise IndexError("index %d is out of bounds for %s of size %d" % (key, self.__class__.__name__, n))
+            key = key + n if key < 0 else key
+            i = offsets.searchsorted(key, 'right')
+            return self.ends[i] - (offsets[i] - key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return self._slice(start, stop)[::step] if step > 0 else self._slice(stop + 1, start + 1)[::step]
+        return self.toarray()[key]
+
+    def __contains__(self, atomnumber):
+        return bool(numpy.any((self.starts <= atomnumber) & (atomnumber < self.ends)))
+
+    def min(self, axis=None, out=None, **kwargs):
+        if axis in (None, 0, -1) and out is None and not kwargs and len(self.starts):
+            return self.dtype.type(self.starts.min())
+        return self.toarray().min(axis=axis, out=out, **kwargs)
+
+    def max(self, axis=None, out=None, **kwargs):
+        if axis in (None, 0, -1) and out is None and not kwargs and len(self.starts):
+            return self.dtype.type(self.ends.max() - 1)
+        return self.toarray().max(axis=axis, out=out, **kwargs)
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def dtype(self):
+        return self.starts.dtype
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, " ".join(
+            "%d" % start if end == start + 1 else "%d-%d" % (start, end - 1)
+            for start, end in zip(self.starts.tolist(), self.ends.tolist())))
+
+
+class RangeSet(IndexRanges):
+    """:class:`IndexSet` stored as sorted, disjoint runs of atom numbers.
+
+    The set operations work on the runs without materializing the atom
+    numbers; operands that are not :class:`RangeSet` are combined as
+    :class:`IndexSet`. Like :class:`IndexSet`, ``'+'`` and ``'|'`` are the
+    union and ``'-'`` and ``'&'`` the intersection.
+    """
+    __slots__ = ()
+
+    def _combine(self, other, op):
+        """Combine the runs with the runs of *other* with the boolean *op*.
+
+        The boundaries of all runs split the atom numbers into elementary
+        intervals that are either completely in or out of each set; the
+        result consists of the intervals for which *op* is true.
+        """
+        points = numpy.sort(numpy.concatenate([self.starts, self.ends, other.starts, other.ends]))
+        if len(points) == 0:
+            return RangeSet(points, points)
+        points = points[numpy.r_[True, points[1:] != points[:-1]]]
+        left = points[:-1]
+        inside = op(numpy.searchsorted(self.starts, left, 'right') > numpy.searchsorted(self.ends, left, 'right'),
+                    numpy.searchsorted(other.starts, left, 'right') > numpy.searchsorted(other.ends, left, 'right'))
+        first = inside & ~numpy.r_[False, inside[:-1]]
+        last = inside & ~numpy.r_[inside[1:], False]
+        return RangeSet(left[first], points[1:][last])
+
+    def _apply(self, others, op, setop):
+        result = self
+        for x in others:
+            if isinstance(result, RangeSet) and isinstance(x, RangeSet):
+                result = result._combine(x, op)
+            else:
+                result = getattr(IndexSet._sorted(numpy.asarray(result)), setop)(x)
+        return result
+
+    def union(self, *others):
+        """Return the atoms in this set or in any of the *others*."""
+        return self._apply(others, numpy.logical_or, 'union')
+
+    def intersection(self, *others):
+        """Return the atoms in this set and in all of the *others*."""
+        return self._apply(others, numpy.logical_and, 'intersection')
+
+    def difference(self, *others):
+        """Return the atoms in this set but in none of the *others*."""
+        return self._apply(others, lambda a, b: a & ~b, 'difference')
+
+    def __contains__(self, atomnumber):
+        i = numpy.searchsorted(self.ends, atomnumber, 'right')
+        return bool(i < len(self.starts) and self.starts[i] <= atomnumber)
+
+    def min(self, axis=None, out=None, **kwargs):
+        if axis in (None, 0, -1) and out is None and not kwargs and len(self.starts):
+            return self.dtype.type(self.starts[0])
+        return self.toarray().min(axis=axis, out=out, **kwargs)
+
+    def max(self, axis=None, out=None, **kwargs):
+        if axis in (None, 0, -1) and out is None and not kwargs and len(self.starts):
+            return self.dtype.type(self.ends[-1] - 1)
+        return self.toarray().max(axis=axis, out=out, **kwargs)
 
-class IndexSet(set):
-    """set which defines '+' as union (OR) and '-' as intersection  (AND)."""
     def __add__(self, x):
         return self.union(x)
 
     def __sub__(self, x):
         return self.intersection(x)
 
+    __or__ = __add__
+    __and__ = __sub__
+
+
+class ReverseIndex(object):
+    """Groups of each atom of an :class:`NDX`, as a bitmap.
+
+    Row *a* of :attr:`bits` holds one bit per group for atom number *a*
+    (bit ``nr % 8`` of byte ``nr // 8`` for the group at position *nr* of
+    :attr:`NDX.groups`, counting from 0 and including duplicate groups), so
+    a membership query is a single lookup and classifying many atoms is one
+    fancy index.
+
+    **Example** ::
+
+       R = NDX('system.ndx').reverse_index()
+       R.groups_of(123456)              # ['System', 'Protein', ...]
+       R.contains(123456, 'Protein')    # True
+       R.contains(123456, 2)            # only the group at position 2
+       member = R.classify(atoms)       # (len(atoms), number of groups) bool array
+    """
+
+    def __init__(self, ndx):
+        #: names of the groups, the columns of :meth:`classify`
+        self.groups = ndx.all_groups
+        self._nrs = {}  # name -> positions of all groups of that name
+        for nr, name in enumerate(self.groups):
+            self._nrs.setdefault(name, []).append(nr)
+        arrays = [numpy.asarray(ndx._load(nr)) for nr in range(len(self.groups))]
+        natoms = max([int(a.max()) + 1 for a in arrays if len(a)] or [0])
+        self.bits = numpy.zeros((natoms, (len(self.groups) + 7) // 8), dtype=numpy.uint8)
+        for nr, atomnumbers in enumerate(arrays):
+            self.bits[atomnumbers, nr >> 3] |= numpy.uint8(1 << (nr & 7))
+
+    def _group_nrs(self, group):
+        """Positions of *group*, a group number or name (all groups of that name)."""
+        if isinstance(group, str):
+            return self._nrs[group]
+        if not 0 <= group < len(self.groups):
+            raise KeyError("No index group number %d, there are %d groups." % (group, len(self.groups)))
+        return [group]
+
+    def contains(self, atomnumber, group):
+        """Return ``True`` if atom *atomnumber* is in *group*.
+
+        *group* is a group number or a name; a name matches any of the
+        groups of that name, like :meth:`groups_of`.
+        """
+        nrs = self._group_nrs(group)
+        if not 0 <= atomnumber < len(self.bits):
+            return False
+        row = self.bits[atomnumber]
+        return any(row[nr >> 3] >> (nr & 7) & 1 for nr in nrs)
+
+    def groups_of(self, atomnumber):
+        """Return the names of all groups that contain atom *atomnumber*."""
+        if not 0 <= atomnumber < len(self.bits):
+            return []
+        nrs = numpy.flatnonzero(numpy.unpackbits(self.bits[atomnumber], bitorder='little'))
+        return [self.groups[nr] for nr in nrs.tolist()]
+
+    def classify(self, atomnumbers):
+        """Classify the atoms *atomnumbers* into the groups.
+
+        :Returns: boolean array of shape ``(len(atomnumbers), len(groups))``,
+                  ``True`` where atom *i* is in group *j* of :attr:`groups`
+        """
+        atomnumbers = numpy.ravel(numpy.asarray(atomnumbers)).astype(int)
+        known = (atomnumbers >= 0) & (atomnumbers < len(self.bits))
+        rows = numpy.zeros((len(atomnumbers), self.bits.shape[1]), dtype=numpy.uint8)
+        rows[known] = self.bits[atomnumbers[known]]
+        return numpy.unpackbits(rows, axis=1, count=len(self.groups), bitorder='little').astype(bool)
+
 
 class uniqueNDX(NDX):
     """Index that behaves like make_ndx, i.e. entries behaves as sets,
     not lists.
 
-    The index lists behave like sets:
+    The index lists behave like sets (:class:`IndexSet`, sorted arrays of
+    unique atom numbers):
     - adding sets with '+' is equivalent to a logical OR: x + y == "x | y"
     - subtraction '-' is AND: x - y == "x & y"
     - see :meth:`~gromacs.formats.join` for ORing multiple groups (x+y+z+...)
@@ -267,13 +1130,22 @@ class uniqueNDX(NDX):
         return self._sum([self[k] for k in groupnames if k in self])
 
     def _sum(self, sequence):
-        return reduce(operator.add, sequence)
+        """Union of all sets in *sequence* in a single sort (or on their runs)."""
+        if len(sequence) == 0:
+            return IndexSet()
+        if all(isinstance(x, RangeSet) for x in sequence):
+            return sequence[0].union(*sequence[1:])
+        return IndexSet(numpy.concatenate([numpy.asarray(x) for x in sequence]))
 
     def _transform(self, v):
-        return IndexSet(v)
-
-    def _getarray(self, k):
-        return numpy.sort(numpy.fromiter(self[k], dtype=int, count=len(self[k])))
+        if isinstance(v, RangeSet):
+            return v
+        if isinstance(v, IndexSet):
+            v = v.copy()    # IndexSet(v) is v, which would be shared by both groups
+        return RangeSet.encode(IndexSet(v), self.min_run)
+
+    def _toarray(self, value):
+        return numpy.asarray(value)
 
 
 
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+make_ndx-style selections over index groups
+===========================================
+
+A selection expression such as ::
+
+   SOL & !r 1-100 | a OW
+
+is compiled by :class:`Selection` into a plan (a small tree of tuples) that is
+evaluated with the vectorized set operations of
+:class:`~gromacs.fileformats.ndx.IndexSet`, so no :program:`make_ndx` process
+is needed to build index groups.
+
+The syntax follows :program:`make_ndx`:
+
+``name`` or ``"name"``
+   index group *name*; a bare number *n* is the *n*-th group (counting from 0
+   like :program:`make_ndx`)
+``a 1-100 205``
+   atom numbers and ranges of atom numbers (inclusive)
+``a OW HW*``
+   atom names, a trailing ``*`` matches any suffix
+``r 1-100`` / ``r SOL``
+   residue numbers or residue names
+``!``, ``&``, ``|``, ``( )``
+   NOT, AND, OR (in order of precedence) and grouping
+
+Atom and residue names and residue numbers need an *atoms* table, e.g. the
+data of an ITP ``[ atoms ]`` section: anything with the fields ``atomname``,
+``resnr`` and ``resname`` for the atoms 1, 2, ...
+
+**Example** ::
+
+   I = uniqueNDX('system.ndx')
+   I['water_O'] = I.select('SOL & a OW', atoms=itp.header.moleculetype.atoms.data)
+
+.. autoclass:: Selection
+   :members:
+.. autofunction:: select
+"""
+
+import functools
+import re
+
+import numpy
+
+from .ndx import IndexSet
+
+TOKEN = re.compile(r'''\s*(?:(?P<op>[&|!()])|"(?P<quoted>[^"]*)"|(?P<range>\d+\s*-\s*\d+)|(?P<word>[^\s&|!()"]+))''')
+
+
+class Selection(object):
+    """A compiled make_ndx-style selection expression.
+
+    :attr:`plan` is a tree of tuples, e.g. ``('and', ('group', 'SOL'),
+    ('not', ('resnr', [(1, 100)])))``. The last :attr:`cachesize` compiled
+    plans are cached, so compiling the same expression again is free.
+    """
+    #: number of compiled expressions kept (fixed when the class is created)
+    cachesize = 1024
+
+    def __new__(cls, expression):
+        return cls._compile(expression)
+
+    @classmethod
+    @functools.lru_cache(maxsize=cachesize)
+    def _compile(cls, expression):
+        self = super(Selection, cls).__new__(cls)
+        self.expression = expression
+        self._tokens = self._tokenize(expression)
+        self._pos = 0
+        self.plan = self._parse_or()
+        if self._pos != len(self._tokens):
+            raise SyntaxError("Unexpected %r in selection %r." % (self._tokens[self._pos][1], expression))
+        del self._tokens
+        return self
+
+    def __repr__(self):
+        return "<Selection %r>" % self.expression
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            m = TOKEN.match(expression, pos)
+            if m is None:
+                raise SyntaxError("Can not parse selection %r at %r." % (expression, expression[pos:]))
+            tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+        return tokens
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise SyntaxError("Unexpected end of selection %r." % self.expression)
+        self._pos += 1
+        return token
+
+    def _parse_or(self):
+        plan = self._parse_and()
+        while self._peek() == ('op', '|'):
+            self._pos += 1
+            plan = ('or', plan, self._parse_and())
+        return plan
+
+    def _parse_and(self):
+        plan = self._parse_not()
+        while self._peek() == ('op', '&'):
+            self._pos += 1
+            plan = ('and', plan, self._parse_not())
+        return plan
+
+    def _parse_not(self):
+        if self._peek() == ('op', '!'):
+            self._pos += 1
+            return ('not', self._parse_not())
+        return self._parse_atom()
+
+    def _parse_atom(self):
+        kind, value = self._next()
+        if (kind, value) == ('op', '('):
+            plan = self._parse_or()
+            if self._next() != ('op', ')'):
+                raise SyntaxError("Missing ')' in selection %r." % self.expression)
+            return plan
+        if kind == 'word' and value in ('a', 'r'):
+            return self._parse_specs(value)
+        if kind == 'quoted' or (kind == 'word' and not value.isdigit()):
+            return ('group', value)
+        if kind == 'word':
+            return ('groupnr', int(value))
+        raise SyntaxError("Unexpected %r in selection %r." % (value, self.expression))
+
+    def _parse_specs(self, keyword):
+        """Parse the numbers, ranges or names after 'a' or 'r'."""
+        numbers, names = [], []
+        while self._peek()[0] in ('range', 'word', 'quoted'):
+            kind, value = self._next()
+            if kind == 'range':
+                numbers.append(tuple(int(x) for x in value.split('-')))
+            elif kind == 'word' and value.isdigit():
+                numbers.append((int(value), int(value)))
+            else:
+                names.append(value)
+        if numbers and names:
+            raise SyntaxError("Can not mix numbers and names after %r in selection %r." % (keyword, self.expression))
+        if not numbers and not names:
+            raise SyntaxError("Missing numbers or names after %r in selection %r." % (keyword, self.expression))
+        if keyword == 'a':
+            return ('atomnr', numbers) if numbers else ('atomname', names)
+        return ('resnr', numbers) if numbers else ('resname', names)
+
+    def evaluate(self, ndx, atoms=None):
+        """Evaluate the selection.
+
+        :Arguments:
+          *ndx*
+              :class:`~gromacs.fileformats.ndx.NDX` (or
+              :class:`~gromacs.fileformats.ndx.uniqueNDX`) with the groups
+          *atoms*
+              table with the fields ``atomname``, ``resnr`` and ``resname``
+              of all atoms, needed for atom names and residues
+
+        :Returns: :class:`~gromacs.fileformats.ndx.IndexSet`
+        """
+        return _Evaluator(ndx, atoms).run(self.plan)
+
+
+class _Evaluator(object):
+    """Run a selection plan with vectorized set operations."""
+
+    def __init__(self, ndx, atoms):
+        self.ndx = ndx
+        self.atoms = atoms
+        self._groups = {}
+
+    def run(self, plan):
+        op = plan[0]
+        if op == 'or':
+            return self.run(plan[1]).union(self.run(plan[2]))
+        if op == 'and':
+            left, right = plan[1], plan[2]
+            if right[0] == 'not':
+                return self.run(left).difference(self.run(right[1]))
+            if left[0] == 'not':
+                return self.run(right).difference(self.run(left[1]))
+            return self.run(left).intersection(self.run(right))
+        if op == 'not':
+            return self.universe().difference(self.run(plan[1]))
+        return getattr(self, op)(plan[1])
+
+    def universe(self):
+        """All atoms: 1 .. number of atoms in *atoms* or the largest atom number in the index."""
+        if self.atoms is not None:
+            natoms = len(self._field('atomname', 'name', 'resnr'))
+        else:
+            natoms = max([int(numpy.max(v)) for v in self.ndx.values() if len(v)] or [0])
+        return IndexSet._sorted(numpy.arange(1, natoms + 1))
+
+    def group(self, name):
+        if name not in self._groups:
+            if name not in self.ndx:
+                raise KeyError("No index group %r." % name)
+            self._groups[name] = IndexSet(self.ndx[name])
+        return self._groups[name]
+
+    def groupnr(self, nr):
+        groups = self.ndx.groups
+        if nr >= len(groups):
+            raise KeyError("No index group number %d, there are %d groups." % (nr, len(groups)))
+        return IndexSet(self.ndx.get_all(groups[nr])[groups[:nr].count(groups[nr])])
+
+    @staticmethod
+    def _ranges(ranges):
+        return IndexSet(numpy.concatenate([numpy.arange(lo, hi + 1) for lo, hi in ranges]))
+
+    def _field(self, *names):
+        if self.atoms is None:
+            raise ValueError("Selecting atom or residue names and residue numbers needs the atoms table.")
+        for name in names:
+            try:
+                return numpy.asarray(self.atoms[name])
+            except (KeyError, ValueError, IndexError):
+                continue
+        raise ValueError("The atoms table has no field %s." % " or ".join(names))
+
+    @staticmethod
+    def _match(values, names):
+        """Mask of the values matching any name, a trailing '*' is a wildcard."""
+        values = values.astype(str)
+        exact = [name for name in names if not name.endswith('*')]
+        mask = numpy.isin(values, exact)
+        for name in names:
+            if name.endswith('*'):
+                mask |= numpy.char.startswith(values, name[:-1])
+        return mask
+
+    def atomnr(self, ranges):
+        return self._ranges(ranges)
+
+    def atomname(self, names):
+        return IndexSet._sorted(numpy.flatnonzero(self._match(self._field('atomname', 'name'), names)) + 1)
+
+    def resnr(self, ranges):
+        resnr = self._field('resnr')
+        return IndexSet._sorted(numpy.flatnonzero(numpy.isin(resnr, self._ranges(ranges))) + 1)
+
+    def resname(self, names):
+        return IndexSet._sorted(numpy.flatnonzero(self._match(self._field('resname'), names)) + 1)
+
+
+def select(ndx, expression, atoms=None):
+    """Evaluate the make_ndx-style selection *expression* over the groups of *ndx*.
+
+    See :class:`Selection` and :meth:`Selection.evaluate`.
+    """
+    return Selection(expression).evaluate(ndx, atoms)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Gromacs topology (top) file
+===========================
+
+:class:`TOP` reads a whole topology: the ``.top`` file and, recursively, all
+files pulled in with ``#include``. The include files are searched like
+:program:`grompp` does:
+
+1. the directory of the file containing the ``#include``
+2. the *includedirs* given to :class:`TOP`
+3. the directories in the environment variable :envvar:`GMXLIB`
+4. ``$GMXDATA/top``
+
+The directives ``#include``, ``#define VAR [value]``, ``#undef``,
+``#ifdef``, ``#ifndef``, ``#else`` and ``#endif`` are evaluated while the
+files are read, with the variables defined at that point (as by
+:program:`grompp`), so a variable defined in an included file is seen by
+everything after the ``#include``. A variable defined with a value is a
+macro that is substituted in the data lines, e.g. ``gb_1`` in GROMOS
+``[ bonds ]``.
+
+Every file is read only once per process (cached by absolute path, size
+and mtime) into the lines of its sections and its directives, which are
+evaluated for each topology. The sections are parsed on first use with the
+section classes of :mod:`~gromacs.fileformats.itp` and kept; unknown
+sections become a :class:`~gromacs.fileformats.itp.Dummy`. Topologies that
+share a force field therefore parse its files only once, also with different
+defines.
+
+**Example** ::
+
+   top = TOP('topol.top', includedirs=['/opt/ff'], POSRES=True)
+   top.system.data                       # title lines
+   top.molecules.data                    # (name, number) records
+   top.moleculetypes['SOL'].atoms.data
+
+.. Note::
+
+   The cached sections are shared by all :class:`TOP` instances; copy the
+   data before modifying it.
+
+.. autoclass:: TOP
+   :members:
+.. autoclass:: TopologyFile
+   :members:
+.. autoclass:: SectionLines
+   :members:
+.. autoclass:: Conditions
+   :members:
+"""
+
+import os
+import re
+import logging
+from collections import OrderedDict
+
+import gromacs.utilities as utilities
+from .itp import (SectionList, ITPSection, ITPdata, Dummy, Atomtypes, Moleculetype,
+                  Atoms, Bonds, Angles, Dihedrals, Pairs, Exclusions)
+
+
+class System(ITPSection):
+    """TOP ``[ system ]`` section, the title of the system.
+
+    Example format::
+
+       [ system ]
+       ; Name
+       Protein in water
+    """
+    name = "system"
+
+    def process(self, line):
+        m = self.COMMENT.match(line)
+        if m:
+            self.comments.append(m.group('comment'))
+            return
+        self.data.append(line)
+
+    def section(self):
+        return "[ %s ]\n; Name\n" % self.name + "".join(line + "\n" for line in self.data)
+
+
+class Molecules(ITPdata):
+    """TOP ``[ molecules ]`` section.
+
+    Example format::
+
+       [ molecules ]
+       ; Compound        #mols
+       Protein_chain_A     1
+       SOL              2155
+    """
+    name = "molecules"
+    dtypes = [("name", "U20"), ("number", "i4")]
+    fmt = ["%-15s", "%6d"]
+    column_comment = "; Compound        #mols"
+
+
+def expand(line, macros):
+    """Return the data *line* with the *macros* (name -> value) substituted."""
+    if line.lstrip().startswith(';'):
+        return line
+    data, sep, comment = line.partition(';')
+    return " ".join(macros.get(word, word) for word in data.split()) + " " * bool(sep) + sep + comment
+
+
+class Conditions(object):
+    """The state of the directives while the entries of a file are evaluated.
+
+    :meth:`evaluate` applies ``#define`` and ``#undef`` to the variables
+    *defines* (name -> value, changed in place) and keeps the open
+    ``#ifdef``/``#ifndef`` *branches*, a list of ``(active outside,
+    condition)``.
+    """
+    def __init__(self, defines, filename, branches=()):
+        self.defines = defines
+        self.filename = filename
+        self.branches = list(branches)
+
+    @property
+    def active(self):
+        """``True`` if the lines at this point are used."""
+        return not self.branches or all(self.branches[-1])
+
+    def evaluate(self, kind, value, linenum):
+        """Evaluate the entry ``(kind, value, linenum)`` (see :attr:`TopologyFile.entries`).
+
+        :Returns: ``True`` for a section, data or ``#include`` in an active branch
+        """
+        if kind in ('ifdef', 'ifndef'):
+            self.branches.append((self.active, (value in self.defines) == (kind == 'ifdef')))
+        elif kind in ('else', 'endif'):
+            if not self.branches:
+                raise SyntaxError("File %r, line %d: #%s without #ifdef" % (self.filename, linenum, kind))
+            outside, condition = self.branches.pop()
+            if kind == 'else':
+                self.branches.append((outside, not condition))
+        elif not self.active:
+            pass
+        elif kind == 'define':
+            self.defines[value[0]] = value[1]
+        elif kind == 'undef':
+            self.defines.pop(value, None)
+        else:
+            return True
+        return False
+
+    def close(self):
+        """Check that the file closed all its ``#ifdef``/``#ifndef``."""
+        if self.branches:
+            raise SyntaxError("File %r: missing #endif" % self.filename)
+
+
+class SectionLines(object):
+    """The lines of a section from its header, or after a directive, up to the next header or directive.
+
+    :meth:`parse` parses the lines (as section *name*, with the macros
+    *macros* substituted) on first use and keeps the result.
+    """
+    __slots__ = ('name', 'lines', 'parent', '_words', '_sections')
+
+    def __init__(self, name, parent):
+        self.name = name            # the section of the header above, None at the start of a file
+        self.lines = []
+        self.parent = parent
+        self._words = None
+        self._sections = {}
+
+    @property
+    def words(self):
+        """All words of the data lines, to find the macros used."""
+        if self._words is None:
+            self._words = frozenset(" ".join(line.split(';', 1)[0] for line in self.lines).split())
+        return self._words
+
+    def macros(self, defines):
+        """The macros of *defines* (name -> value) that are used in the lines."""
+        macros = dict((var, value) for var, value in defines.items() if value)
+        if not macros:
+            return macros
+        words = self.words
+        return dict((var, value) for var, value in macros.items() if var in words)
+
+    def expand(self, macros):
+        """Generator of the lines with the *macros* substituted."""
+        for line in self.lines:
+            yield expand(line, macros) if macros else line
+
+    def parse(self, name=None, macros=None):
+        name = name or self.name
+        key = (name, tuple(sorted((macros or {}).items())))
+        if key not in self._sections:
+            section = TopologyFile.parsers.get(name, Dummy)(self.parent)   # argument is the parent!
+            for line in self.expand(macros):
+                section.process(line)
+            self._sections[key] = section
+        return self._sections[key]
+
+
+class TopologyFile(object):
+    """One parsed topology file.
+
+    :attr:`entries` is the content of the file in order, as a list of
+    ``(kind, value, linenum)``: ``('section', lines, linenum)`` for a section
+    header, ``('data', lines, linenum)`` for the following lines of a section
+    after a directive (*lines* is a :class:`SectionLines`), and the
+    directives ``('include', filename, linenum)``, ``('define', (var,
+    value), linenum)``, ``('undef', var, linenum)``, ``('ifdef', var,
+    linenum)``, ``('ifndef', var, linenum)``, ``('else', None, linenum)`` and
+    ``('endif', None, linenum)``, which are evaluated by :class:`TOP`. Use
+    :meth:`load`, which returns the cached instance if the file was already
+    parsed.
+    """
+    logger = logging.getLogger('gromacs.formats.TOP')
+    parsers = {
+        'atomtypes': Atomtypes,
+        'moleculetype': Moleculetype,
+        'atoms': Atoms,
+        'bonds': Bonds,
+        'angles': Angles,
+        'dihedrals': Dihedrals,
+        'pairs': Pairs,
+        'exclusions': Exclusions,
+        'system': System,
+        'molecules': Molecules,
+    }
+    DIRECTIVE = re.compile(r"""#\s*(?P<directive>\w+)\s*(?P<arg>.*?)\s*$""")
+    INCLUDE = re.compile(r"""^["<](?P<filename>[^">]+)[">]$""")
+
+    _cache = {}   # path -> TopologyFile
+
+    def __init__(self, filename, stamp=None, lines=None, firstline=1):
+        self.filename = filename
+        self.stamp = stamp
+        self.entries = []
+        self._merged = {}       # (name, parts) -> section, see merge()
+        if lines is None:
+            with open(filename) as f:
+                self.parse(f)
+        else:
+            self.parse(lines, firstline)
+
+    @classmethod
+    def load(cls, filename):
+        """Return the parsed *filename*, from the cache if the file did not change."""
+        filename = os.path.realpath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_size, st.st_mtime_ns)
+        topfile = cls._cache.get(filename)
+        if topfile is None or topfile.stamp != stamp:
+            topfile = cls._cache[filename] = cls(filename, stamp)
+        return topfile
+
+    @classmethod
+    def clear_cache(cls):
+        """Forget all parsed files."""
+        cls._cache.clear()
+
+    def merge(self, name, parts):
+        """Return the section *name* made of the lines of all *parts*.
+
+        *parts* is a list ``[(lines, macros), ...]`` of the
+        :class:`SectionLines` of a section that is split by directives, the
+        first one from this file. The section is parsed once for each
+        *parts* and kept.
+        """
+        key = (name, tuple((lines, tuple(sorted(macros.items()))) for lines, macros in parts))
+        if key not in self._merged:
+            section = self.parsers.get(name, Dummy)(self)
+            for lines, macros in parts:
+                for line in lines.expand(macros):
+                    section.process(line)
+            self._merged[key] = section
+        return self._merged[key]
+
+    def parse(self, lines, firstline=1):
+        name = None                    # the section of the last header
+        current = None                 # SectionLines that the lines are added to
+        for linenum, line in enumerate(lines, firstline):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line.startswith('#'):
+                self.entries.append(self.directive(line, self.filename, linenum))
+                current = None
+                continue
+            m = ITPSection.SECTION.match(line)
+            if m:
+                name = m.group('name')
+                current = SectionLines(name, self)
+                self.entries.append(('section', current, linenum))
+                continue
+            if current is None:
+                if line.startswith(';'):
+                    continue           # comments before the first section
+                current = SectionLines(name, self)
+                self.entries.append(('data', current, linenum))
+            current.lines.append(line)
+
+    @classmethod
+    def directive(cls, line, filename, linenum):
+        """Return the entry ``(kind, value, linenum)`` of the directive *line* (stripped).
+
+        :Raises: :exc:`SyntaxError` for an unknown directive
+        """
+        m = cls.DIRECTIVE.match(line)
+        directive, arg = (m.group('directive'), m.group('arg')) if m else (None, '')
+        if directive == 'include':
+            m = cls.INCLUDE.match(arg)
+            if m:
+                return ('include', m.group('filename'), linenum)
+        elif directive == 'define' and arg:
+            var, value = (arg.split(';', 1)[0].split(None, 1) + [''])[:2]
+            return ('define', (var, value.strip()), linenum)
+        elif directive in ('undef', 'ifdef', 'ifndef') and len(arg.split()) == 1:
+            return (directive, arg, linenum)
+        elif directive in ('else', 'endif'):
+            return (directive, None, linenum)
+        raise SyntaxError("File %r, line %d: invalid or unsupported directive %r" % (filename, linenum, line))
+
+    def __repr__(self):
+        return "<TopologyFile %s (%d entries)>" % (self.filename, len(self.entries))
+
+
+class TOP(utilities.FileUtils):
+    """Class that represents a Gromacs topology with all its include files.
+
+    All sections of all files are accessible in :attr:`TOP.sections` in the
+    order in which :program:`grompp` sees them, and by attribute access
+    (the last section of a name) ::
+
+       top.sections.getall('atomtypes')
+       top.molecules.data
+
+    The absolute paths of the files read are in :attr:`TOP.files`.
+    """
+    default_extension = "top"
+    logger = logging.getLogger('gromacs.formats.TOP')
+
+    def __init__(self, filename=None, includedirs=None, **kwargs):
+        """Initialize TOP structure.
+
+        :Arguments:
+          *filename*
+              read from top file
+          *includedirs*
+              list of directories searched for ``#include`` files after the
+              directory of the including file
+          *kwargs*
+              ``#define`` *VAR* variables for the pre-processing of the files,
+              e.g. *POSRES* ``= True``; any other value than ``True`` or
+              ``False`` is the value of the macro *VAR*
+        """
+        self.defines = kwargs
+        self.includedirs = list(includedirs or [])
+
+        super(TOP, self).__init__()
+
+        self.sections = SectionList()
+        self.files = []
+        self._moleculetypes = None
+        self._open = None
+
+        if not filename is None:
+            self._init_filename(filename)
+            self.read(filename)
+
+    def read(self, filename=None, **defines):
+        """Read the topology *filename* and all its include files.
+
+        Any keywords in *defines* modify the variables given to the
+        constructor; *VAR* = ``False`` undefines *VAR*, a value other than
+        ``True`` is the value of the macro *VAR*.
+        """
+        self._init_filename(filename)
+        defines = dict(self.defines, **defines)
+        self.sections = SectionList()
+        self.files = []
+        self._moleculetypes = None
+        self._open = None       # (name, [(SectionLines, macros), ...]) of the last section
+        self._include(self.real_filename,
+                      dict((var, '' if value is True else str(value)) for var, value in defines.items() if value), ())
+        self._close()
+
+    def _include(self, filename, defines, including):
+        """Add the sections of *filename* and its includes.
+
+        The directives are evaluated with the variables *defines* (name ->
+        value), which are updated in place.
+        """
+        if filename in including:
+            raise ValueError("Recursive #include of %r in %r." % (filename, including[-1]))
+        topfile = TopologyFile.load(filename)
+        self.files.append(topfile.filename)
+        conditions = Conditions(defines, filename)
+        for kind, value, linenum in topfile.entries:
+            if not conditions.evaluate(kind, value, linenum):
+                continue
+            if kind == 'include':
+                path = self.find_include(value, os.path.dirname(topfile.filename))
+                self._include(path, defines, including + (topfile.filename,))
+            elif kind == 'section':
+                self._close()
+                macros = value.macros(defines)
+                self._open = (value.name, [(value, macros)])
+                self.sections.append(value.name, value.parse(macros=macros))
+            elif self._open is None:
+                self.logger.warning("%s:%d: ignoring lines outside of a section", filename, linenum)
+            else:
+                self._open[1].append((value, value.macros(defines)))
+        conditions.close()
+
+    def _close(self):
+        """Finish the last section; if it is split by directives, replace it by the section of all its parts."""
+        if self._open is not None:
+            name, parts = self._open
+            if len(parts) > 1:
+                self.sections[name] = parts[0][0].parent.merge(name, parts)
+            self._open = None
+
+    def include_path(self):
+        """List of the directories searched for ``#include`` files (after the directory of the including file)."""
+        path = list(self.includedirs)
+        path.extend(d for d in os.environ.get('GMXLIB', '').split(os.pathsep) if d)
+        if os.environ.get('GMXDATA'):
+            path.append(os.path.join(os.environ['GMXDATA'], 'top'))
+        return path
+
+    def find_include(self, name, directory):
+        """Return the path of the ``#include`` file *name* included from a file in *directory*.
+
+        :Raises: :exc:`IOError` if the file is not found
+        """
+        for d in [directory] + self.include_path():
+            path = os.path.join(d, name)
+            if os.path.isfile(path):
+                return os.path.realpath(path)
+        raise IOError("Include file %r not found in %s." % (name, ", ".join([directory] + self.include_path())))
+
+    @property
+    def moleculetypes(self):
+        """Ordered dict of the molecule types by name.
+
+        Each :class:`~gromacs.fileformats.itp.Moleculetype` holds the sections
+        that follow its ``[ moleculetype ]`` header, also from other files
+        (e.g. ``[ position_restraints ]`` from an included ``posre.itp``).
+        """
+        if self._moleculetypes is None:
+            self._moleculetypes = OrderedDict()
+            molecule = None
+            for name, section in self.sections.items():
+                if name == 'moleculetype':
+                    molecule = Moleculetype(self)
+                    molecule.data.update(section.data)
+                    molecule.comments.extend(section.comments)
+                    self._moleculetypes[molecule.data['name']] = molecule
+                elif name in ('system', 'molecules'):
+                    molecule = None
+                elif molecule is not None:
+                    molecule.sections.append(name, section)
+        return self._moleculetypes
+
+    def __getattribute__(self, name):
+        try:
+            return super(TOP, self).__getattribute__(name)
+        except AttributeError:
+            pass
+        try:
+            return self.sections[name]
+        except KeyError:
+            raise AttributeError("%r object has no attribute or section %s" % (self.__class__.__name__, name))
@@ -1,51 +1,827 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import glob
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import re
+from collections import namedtuple
+
+import numpy
+
+import logging
+logger = logging.getLogger('gromacs.fileformats.xvg')
+
+# match:  @ s0 legend "Potential"
+LEGEND = re.compile(r'''^@\s*s(?P<set>\d+)\s+legend\s+"(?P<legend>.*)"''')
+# lines which are not part of the numeric block
+NOT_DATA = (b'#', b'@', b'&')
+
+#: units understood by :meth:`Xvg.convert`: unit -> (quantity, factor to the Gromacs unit)
+UNITS = {
+    'kJ/mol': ('energy', 1.0), 'J/mol': ('energy', 1e-3), 'kcal/mol': ('energy', 4.184),
+    'cal/mol': ('energy', 4.184e-3), 'eV': ('energy', 96.485332), 'kT': ('energy', 2.4943387),  # kT at 300 K
+    'nm': ('length', 1.0), 'A': ('length', 0.1), 'pm': ('length', 1e-3), 'um': ('length', 1e3),
+    'ps': ('time', 1.0), 'fs': ('time', 1e-3), 'ns': ('time', 1e3), 'us': ('time', 1e6),
+    'bar': ('pressure', 1.0), 'atm': ('pressure', 1.01325), 'Pa': ('pressure', 1e-5),
+    'kPa': ('pressure', 1e-2), 'MPa': ('pressure', 10.0),
+}
+
+
+def _read_header(content):
+    '''Read the header lines of a xvg file.
+
+    The header is the leading block of ``#``/``@`` lines and empty lines.
+
+    @para
+        content: the content of the file as bytes or a mmap
+    @return
+        (list of header lines as str, offset of the numeric block)
+    '''
+    header = []
+    pos = 0
+    while pos < len(content):
+        end = content.find(b'\n', pos)
+        end = len(content) if end == -1 else end + 1
+        line = content[pos:end].strip()
+        if line and not line.startswith(NOT_DATA):
+            break
+        header.append(content[pos:end].decode().rstrip('\r\n'))
+        pos = end
+    return header, pos
+
+
+def _parse_block(block, ncols=None):
+    '''Convert a numeric block of a xvg file to a 2-D array in a single pass.
+
+    Lines starting with ``#``, ``@`` or ``&`` inside the block are skipped.
+
+    @para
+        block: the numeric block as bytes
+        ncols: the number of columns, guessed from the first line if None
+    @return
+        a contiguous float array with shape (rows, ncols)
+    '''
+    if any(c in block for c in NOT_DATA):
+        block = b'\n'.join(line for line in block.splitlines()
+                           if not line.lstrip().startswith(NOT_DATA))
+    if ncols is None:
+        first = block.lstrip().split(b'\n', 1)[0]
+        ncols = len(first.split()) or 2
+    # count the values of each line: a value starts at a non-whitespace byte after whitespace
+    buf = numpy.frombuffer(block, dtype=numpy.uint8)
+    space = buf <= 32   # whitespace (and control bytes, which are no numbers either)
+    starts = ~space
+    starts[1:] &= space[:-1]
+    lines = numpy.concatenate(([0], numpy.flatnonzero(buf == 10) + 1))
+    counts = numpy.add.reduceat(starts, lines[lines < len(buf)], dtype=numpy.intp) if len(buf) else lines[:0]
+    counts = counts[counts > 0]    # blank lines
+    if len(counts) == 0:
+        return numpy.zeros((0, ncols))
+    if (counts != ncols).any():
+        bad = numpy.flatnonzero(counts != ncols)[0]
+        raise Exception("The number of datas in each row is not equal: data line %d has %d values, not %d."
+                        % (bad + 1, counts[bad], ncols))
+    values = numpy.fromstring(block, sep=' ')
+    if values.size != len(counts) * ncols:
+        raise Exception("Failed to parse %d lines of %d columns of numbers." % (len(counts), ncols))
+    return values.reshape(-1, ncols)
+
+
+def _data_line_starts(buf, start, stride, chunksize=1 << 24):
+    '''Get the offsets of every *stride*-th data line of a buffer.
+
+    The newlines are searched in chunks of *chunksize* bytes with NumPy, so
+    the memory needed does not depend on the size of the buffer. Each line is
+    classified by its first non-whitespace byte like in :func:`_parse_block`:
+    empty and blank lines and lines starting with ``#``, ``@`` or ``&`` are
+    not data lines.
+
+    @para
+        buf: the uint8 array of the file
+        start: the offset of the first data line
+        stride: keep the offset of every stride-th data line
+    @return
+        (array of offsets, number of data lines)
+    '''
+    nodata = numpy.zeros(256, dtype=bool)
+    nodata[list(b''.join(NOT_DATA) + b'\n')] = True
+    offsets = []
+    nrows = 0
+    lo = start
+    while lo < len(buf):
+        hi = min(lo + chunksize, len(buf))
+        if hi < len(buf):
+            # end the chunk after a newline, so that no line is split
+            newline = numpy.flatnonzero(buf[lo:hi] == 10)
+            if len(newline):
+                hi = lo + newline[-1] + 1
+            else:                      # a line longer than chunksize
+                newline = buf[hi:] == 10
+                hi = hi + newline.argmax() + 1 if newline.any() else len(buf)
+        chunk = buf[lo:hi]
+        starts = numpy.concatenate(([0], numpy.flatnonzero(chunk == 10) + 1))
+        starts = starts[starts < len(chunk)]
+        # step over the leading whitespace of all lines at once
+        first = starts.copy()
+        blank = numpy.arange(len(first))
+        while len(blank):
+            pos = first[blank]
+            inside = pos < len(chunk)
+            inside[inside] = (chunk[pos[inside]] <= 32) & (chunk[pos[inside]] != 10)
+            blank = blank[inside]
+            first[blank] += 1
+        data = first < len(chunk)
+        data[data] = ~nodata[chunk[first[data]]]
+        starts = starts[data] + lo
+        offsets.append(starts[-nrows % stride::stride])
+        nrows += len(starts)
+        lo = hi
+    offsets = numpy.concatenate(offsets) if offsets else numpy.zeros(0, dtype=numpy.intp)
+    return offsets, nrows
+
+
+#: the statistics of the data sets, see :class:`RunningStatistics`
+Statistics = namedtuple('Statistics', ['n', 'mean', 'var', 'std', 'min', 'max',
+                                       'block_averages', 'block_error'])
+
+
+class RunningStatistics(object):
+    '''Accumulate statistics over chunks of rows in one pass.
+
+    Each chunk is reduced with vectorized NumPy operations and merged into
+    the running mean and variance (Welford/Chan), the minimum and maximum and
+    the averages of consecutive blocks of *blocksize* rows. A trailing
+    incomplete block is not counted. The standard error of the mean is
+    estimated from the scatter of the block averages.
+    '''
+
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        self.n = 0
+        self._mean = self._m2 = self._min = self._max = None
+        self._blocks = []
+        self._partial = []  # rows of the current incomplete block
+
+    def update(self, chunk):
+        '''Add a chunk of rows, a 2-D array with one column per data set.'''
+        chunk = numpy.asarray(chunk, dtype=float)
+        n = len(chunk)
+        if n == 0:
+            return
+        mean = chunk.mean(axis=0)
+        m2 = ((chunk - mean) ** 2).sum(axis=0)
+        if self.n == 0:
+            self._mean, self._m2 = mean, m2
+            self._min, self._max = chunk.min(axis=0), chunk.max(axis=0)
+        else:
+            total = self.n + n
+            delta = mean - self._mean
+            self._mean = self._mean + delta * n / total
+            self._m2 = self._m2 + m2 + delta ** 2 * self.n * n / total
+            self._min = numpy.minimum(self._min, chunk.min(axis=0))
+            self._max = numpy.maximum(self._max, chunk.max(axis=0))
+        self.n += n
+        self._update_blocks(chunk)
+
+    def _update_blocks(self, chunk):
+        '''Split *chunk* into the blocks, completing the partial block first.'''
+        b = self.blocksize
+        filled = sum(len(p) for p in self._partial)
+        if filled:
+            head, chunk = chunk[:b - filled], chunk[b - filled:]
+            self._partial.append(head)
+            if filled + len(head) < b:
+                return
+            self._blocks.append(numpy.concatenate(self._partial).mean(axis=0))
+            self._partial = []
+        nfull = len(chunk) // b
+        if nfull:
+            self._blocks.extend(chunk[:nfull * b].reshape(nfull, b, -1).mean(axis=1))
+        if len(chunk) > nfull * b:
+            self._partial = [chunk[nfull * b:]]
+
+    def result(self):
+        '''Get all the statistics as a :class:`Statistics`.'''
+        var = self._m2 / (self.n - 1) if self.n > 1 else self._m2 * numpy.nan
+        blocks = numpy.array(self._blocks)
+        if len(blocks) > 1:
+            error = blocks.std(axis=0, ddof=1) / numpy.sqrt(len(blocks))
+        else:
+            error = numpy.full_like(self._mean, numpy.nan)
+        return Statistics(self.n, self._mean, var, numpy.sqrt(var), self._min, self._max, blocks, error)
+
+
+def _decimate_bins(array, binsize, method, column):
+    '''Reduce every *binsize* consecutive rows of array, see :func:`decimate`.'''
+    if method == 'stride':
+        return array[::binsize]
+    nfull = len(array) // binsize
+    parts = []
+    for block, size in ((array[:nfull * binsize], binsize), (array[nfull * binsize:], len(array) - nfull * binsize)):
+        if size == 0 or len(block) == 0:
+            continue
+        bins = block.reshape(-1, size, array.shape[1])
+        if method == 'mean':
+            parts.append(bins.mean(axis=1))
+        else:
+            values = bins[:, :, column]
+            index = numpy.sort(numpy.stack([values.argmin(axis=1), values.argmax(axis=1)], axis=1), axis=1)
+            parts.append(block[(index + numpy.arange(len(bins))[:, None] * size).ravel()])
+    return numpy.concatenate(parts) if parts else array[:0]
+
+
+def _lttb(array, npoints, column):
+    '''Largest-Triangle-Three-Buckets downsampling of array to npoints rows.'''
+    n = len(array)
+    if npoints >= n or npoints < 3:
+        return array[::max(-(-n // max(npoints, 1)), 1)]
+    x, y = array[:, 0], array[:, column]
+    edges = numpy.linspace(1, n - 1, npoints - 1).astype(int)
+    selected = numpy.empty(npoints, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    for i in range(npoints - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()  # average of the next bucket
+        ax, ay = x[selected[i]], y[selected[i]]
+        area = numpy.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        selected[i + 1] = lo + area.argmax()
+    return array[selected]
+
+
+def decimate(array, npoints, method='minmax', column=1):
+    '''Downsample the rows of a 2-D array to about npoints rows for plotting.
+
+    @para
+        array: the datas, x is the first column
+        npoints: the number of rows wanted
+        method: 'stride' keeps every n-th row, 'mean' averages bins of rows,
+            'minmax' keeps the rows with the minimum and maximum of *column* in
+            each bin (the envelope), 'lttb' is Largest-Triangle-Three-Buckets
+            on *column*
+        column: the column used by 'minmax' and 'lttb'
+    @return
+        a 2-D array
+    '''
+    if method == 'lttb':
+        return _lttb(array, npoints, column)
+    if method not in ('stride', 'mean', 'minmax'):
+        raise ValueError("Unknown decimation method %r." % method)
+    return _decimate_bins(array, _binsize(len(array), npoints, method), method, column)
+
+
+def _binsize(nrows, npoints, method):
+    '''Get the number of rows reduced to one (two for 'minmax') point.'''
+    if method == 'minmax':
+        npoints //= 2
+    return max(-(-nrows // max(npoints, 1)), 1)
+
+
 class Xvg:
-    '''Parser the xvg file.'''
+    '''Parser the xvg file.
+
+    All the columns of the numeric block are stored in :attr:`array`, a
+    contiguous 2-D array with one row per line. :attr:`x`, :attr:`y` and
+    :attr:`data` are views of it, and the data sets named by the
+    ``@ sN legend`` headers are available with :meth:`series`.
+
+    With *lazy* = ``True`` the file is memory-mapped instead and only a sparse
+    index with the offset of every :attr:`index_stride`-th line is built.
+    :meth:`rows` and :meth:`window` then parse only the lines needed, and
+    the whole :attr:`array` is parsed when it is first used.
+
+    With *cache* = ``True`` the parsed datas are saved to a binary sidecar
+    (``<filename>.cache.npy`` plus the header in ``<filename>.cache.json``)
+    keyed by the path, size and modification time of the xvg file. Later
+    instances memory-map the sidecar instead of parsing the text as long as
+    the xvg file does not change. In the lazy mode the sidecar is written
+    when the whole :attr:`array` is parsed.
+
+    Transforms of whole columns, e.g. ``xvg.convert('x', 'ps', 'ns')`` or
+    ``xvg.scale('Potential', 2).shift('Potential', -10)``, are queued and
+    applied in place when the datas are used next. Consecutive scalings and
+    shifts of a column are merged into a single ``a * v + b``.
+
+    With *follow* = ``True`` the xvg file of a running simulation can be
+    monitored: only complete lines are read and :meth:`refresh` parses just
+    the lines appended since the last read. The cache is not used in this
+    mode, and it can not be combined with *lazy* or a ``.gz`` file.
+    '''
+
+    #: keep the offset of every index_stride-th data line in lazy mode
+    index_stride = 1024
+    #: suffix of the cache sidecar files
+    cache_suffix = '.cache'
 
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, cache=False, follow=False):
+        if follow and lazy:
+            raise ValueError("Xvg: follow=True can not be used with lazy=True.")
+        if follow and filename.endswith('.gz'):
+            raise ValueError("Xvg: follow=True can not be used with the compressed file %s." % filename)
         self.filename = filename
-        self._read_file()
+        self.lazy = lazy
+        self.follow = follow
+        self.cache = cache and not follow
+        self._array = None
+        self._mmap = None
+        self._transforms = {}  # column -> [(a, b) or ufunc, ...]
+        self._applied = {}     # transforms already applied to _array, for the rows of refresh()
+        if self.cache and self._load_cache():
+            return
+        if lazy:
+            self._open_index()
+        else:
+            self._read_file()
+            if self.cache:
+                self._save_cache()
+
+    def _cache_key(self):
+        '''Get the key of the xvg file which validates the cache.'''
+        stat = os.stat(self.filename)
+        return {'source': os.path.realpath(self.filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def _load_cache(self):
+        '''Load the datas from the cache sidecar if it is up to date.
+
+        @return
+            True if the cache was used
+        '''
+        prefix = self.filename + self.cache_suffix
+        try:
+            with open(prefix + '.json') as f:
+                meta = json.load(f)
+            if meta['key'] != self._cache_key():
+                return False
+            # copy-on-write, the datas can be changed without touching the cache
+            self._array = numpy.load(prefix + '.npy', mmap_mode='c')
+        except (IOError, ValueError, KeyError):
+            return False
+        self.header = meta['header']
+        self.legends = meta['legends']
+        return True
+
+    def _save_cache(self):
+        '''Save the datas to the cache sidecar, the header is written last.'''
+        prefix = self.filename + self.cache_suffix
+        try:
+            numpy.save(prefix + '.npy', self._array)
+            with open(prefix + '.json', 'w') as f:
+                json.dump({'key': self._cache_key(), 'header': self.header, 'legends': self.legends}, f)
+        except IOError as err:
+            logger.warning("Failed to write the cache of %s: %s", self.filename, err)
 
     def _read_file(self):
         '''Parser the xvg file.'''
-        self.x = []
-        self.y = []
-        with open(self.filename) as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#') or line.startswith('@') or line == '':
-                    continue
-                x, y = line.split()[:2]
-                self.x.append(float(x))
-                self.y.append(float(y))
-        if len(self.x) != len(self.y):
-            raise Exception("The number of datas at x and y axes is not equal.")
-
-    def alter_x(self, func):
+        with (gzip.open if self.filename.endswith('.gz') else open)(self.filename, 'rb') as f:
+            content = f.read()
+        if self.follow:
+            # the last line may be still being written
+            content = content[:content.rfind(b'\n') + 1]
+            self._offset = len(content)
+        self.header, pos = _read_header(content)
+        self.legends = self._read_legends(self.header)
+        self._array = self._buffer = _parse_block(content[pos:])
+
+    def refresh(self):
+        '''Read the lines appended to the xvg file since the last read (follow mode).
+
+        Only complete lines after the last read offset are parsed; they are
+        added to :attr:`array` with amortized growth and get the transforms
+        applied to the older rows. The file is read again from the start if
+        it became shorter or had no datas yet.
+
+        @return
+            the number of new lines
+        '''
+        if not self.follow:
+            raise Exception("Xvg.refresh() needs Xvg(filename, follow=True).")
+        if self.nrows == 0 or os.path.getsize(self.filename) < self._offset:
+            self._read_file()
+            self._apply_transforms(self._array, self._applied)
+            return self.nrows
+        with open(self.filename, 'rb') as f:
+            f.seek(self._offset)
+            content = f.read()
+        content = content[:content.rfind(b'\n') + 1]
+        if not content:
+            return 0
+        self._offset += len(content)
+        block = self._apply_transforms(_parse_block(content, self._array.shape[1]), self._applied)
+        n, m = len(self._array), len(block)
+        if n + m > len(self._buffer):
+            self._buffer = numpy.empty((max(2 * len(self._buffer), n + m), block.shape[1]))
+            self._buffer[:n] = self._array
+        self._buffer[n:n + m] = block
+        self._array = self._buffer[:n + m]
+        return m
+
+    def _open_index(self):
+        '''Memory-map the xvg file and build the sparse index of the data lines.'''
+        with open(self.filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b''
+        self.header, pos = _read_header(self._mmap)
+        self.legends = self._read_legends(self.header)
+        buf = numpy.frombuffer(self._mmap, dtype=numpy.uint8)
+        self._offsets, self._nrows = _data_line_starts(buf, pos, self.index_stride)
+        end = self._mmap.find(b'\n', pos)
+        self._ncols = len(self._mmap[pos:end if end != -1 else len(self._mmap)].split()) or 2
+        # the x value of each indexed line, to locate the time windows
+        self._index_x = numpy.array([float(self._mmap[o:o + 64].split(None, 1)[0]) for o in self._offsets])
+
+    def _parse_rows(self, start, stop):
+        '''Parse the lines from *start* to *stop* from the memory-mapped file.'''
+        stride = self.index_stride
+        first = start // stride
+        last = -(-stop // stride)
+        lo = self._offsets[first]
+        hi = self._offsets[last] if last < len(self._offsets) else len(self._mmap)
+        block = _parse_block(self._mmap[lo:hi], self._ncols)
+        return block[start - first * stride:stop - first * stride]
+
+    def close(self):
+        '''Close the memory-mapped file of the lazy mode.'''
+        if self.lazy and isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+
+    @property
+    def array(self):
+        '''Get the datas of all columns as a 2-D array, one row per line.'''
+        if self._array is None:
+            self._array = self._parse_rows(0, self._nrows) if self._nrows else numpy.zeros((0, self._ncols))
+            if self.cache:
+                self._save_cache()
+        if self._transforms:
+            self._apply_transforms(self._array)
+            for column, transforms in self._transforms.items():
+                self._applied.setdefault(column, []).extend(transforms)
+            self._transforms = {}
+        return self._array
+
+    @property
+    def nrows(self):
+        '''Get the number of data lines.'''
+        return len(self._array) if self._array is not None else self._nrows
+
+    def rows(self, start, stop=None):
+        '''Get the datas of the lines from *start* to *stop* (excluded).
+
+        In the lazy mode only these lines are parsed from the file.
+
+        @para
+            start: the index of the first line, starting from 0
+            stop: the index after the last line, all lines to the end if None
+        @return
+            a 2-D array
+        '''
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        if self._array is not None:
+            return self.array[start:stop]
+        if start >= stop:
+            return numpy.zeros((0, self._ncols))
+        return self._apply_transforms(self._parse_rows(start, stop))
+
+    def window(self, t0, t1):
+        '''Get the datas of the lines with t0 <= x <= t1.
+
+        The x values must be in ascending order, e.g. the time, also after
+        any transforms. In the lazy mode only the index blocks overlapping the
+        window are parsed.
+
+        @para
+            t0: the lower bound of x
+            t1: the upper bound of x
+        @return
+            a 2-D array
+        '''
+        if self._array is not None:
+            block = self.array
+        else:
+            stride = self.index_stride
+            index_x = self._apply_column(self._index_x.copy(), self._transforms.get(0, []))
+            first = max(numpy.searchsorted(index_x, t0, 'right') - 1, 0)
+            last = numpy.searchsorted(index_x, t1, 'right')
+            block = self.rows(first * stride, last * stride)
+        x = block[:, 0]
+        return block[numpy.searchsorted(x, t0, 'left'):numpy.searchsorted(x, t1, 'right')]
+
+    @staticmethod
+    def _read_legends(header):
+        '''Get the legends of the data sets from the header lines.'''
+        legends = {}
+        for line in header:
+            m = LEGEND.match(line)
+            if m:
+                legends[int(m.group('set'))] = m.group('legend')
+        return [legends.get(i, 's%d' % i) for i in range(max(legends) + 1)] if legends else []
+
+    def _column(self, name):
+        '''Get the index in :attr:`array` of a column.
+
+        @para
+            name: 'x', 'y', the legend of a data set or its number in the xvg file (s0 is 0)
+        '''
+        if name == 'x':
+            return 0
+        if name == 'y':
+            return 1
+        if not isinstance(name, int):
+            if name not in self.legends:
+                raise KeyError("No data set with legend %r in %s." % (name, self.filename))
+            name = self.legends.index(name)
+        return name + 1
+
+    def series(self, name):
+        '''Get the values of a data set.
+
+        @para
+            name: the legend of the data set, or its number in the xvg file (s0 is 0)
+        @return
+            a view of the column in :attr:`array`
+        '''
+        return self.array[:, self._column(name)]
+
+    @staticmethod
+    def _apply_column(values, transforms):
+        '''Apply the transforms to the 1-D array values in place.'''
+        for op in transforms:
+            if isinstance(op, tuple):
+                a, b = op
+                if a != 1:
+                    numpy.multiply(values, a, out=values)
+                if b != 0:
+                    numpy.add(values, b, out=values)
+            elif isinstance(op, numpy.ufunc):
+                op(values, out=values)
+            else:
+                values[...] = op(values)
+        return values
+
+    def _apply_transforms(self, block, transforms=None):
+        '''Apply the queued transforms (or *transforms*) to the 2-D array block in place.'''
+        transforms = self._transforms if transforms is None else transforms
+        for column, ops in transforms.items():
+            self._apply_column(block[:, column], ops)
+        return block
+
+    def transform(self, column, func):
+        '''Queue a vectorized transform of a column.
+
+        @para
+            column: see :meth:`scale`
+            func: a NumPy ufunc, e.g. numpy.log, or a function mapping an array to an array
+        @return
+            self, so that transforms can be chained
+        '''
+        self._transforms.setdefault(self._column(column), []).append(func)
+        return self
+
+    def scale(self, column, factor, offset=0.0):
+        '''Queue the transform ``v * factor + offset`` of a column.
+
+        @para
+            column: 'x', 'y', the legend of a data set or its number in the xvg file (s0 is 0)
+            factor: the scale factor
+            offset: the value added after scaling
+        @return
+            self, so that transforms can be chained
+        '''
+        transforms = self._transforms.setdefault(self._column(column), [])
+        if transforms and isinstance(transforms[-1], tuple):
+            a, b = transforms[-1]
+            transforms[-1] = (a * factor, b * factor + offset)
+        else:
+            transforms.append((factor, offset))
+        return self
+
+    def shift(self, column, offset):
+        '''Queue the transform ``v + offset`` of a column, see :meth:`scale`.'''
+        return self.scale(column, 1.0, offset)
+
+    def convert(self, column, from_unit, to_unit):
+        '''Queue the unit conversion of a column, see :data:`UNITS` for the units.
+
+        **Example** ::
+
+           xvg.convert('x', 'ps', 'ns').convert('Potential', 'kJ/mol', 'kcal/mol')
+        '''
+        try:
+            (quantity, a), (to_quantity, b) = UNITS[from_unit], UNITS[to_unit]
+        except KeyError as err:
+            raise ValueError("Unknown unit %s, the known units are %s." % (err, ", ".join(UNITS)))
+        if quantity != to_quantity:
+            raise ValueError("Can not convert %s (%s) to %s (%s)." % (from_unit, quantity, to_unit, to_quantity))
+        return self.scale(column, a / b)
+
+    def iter_chunks(self, chunksize=None):
+        '''Iterate over the datas in chunks of *chunksize* lines.
+
+        In the lazy mode each chunk is parsed from the file when it is needed.
+
+        @para
+            chunksize: the number of lines of a chunk, 64 * index_stride if None
+        '''
+        chunksize = chunksize or 64 * self.index_stride
+        for start in range(0, self.nrows, chunksize):
+            yield self.rows(start, start + chunksize)
+
+    def statistics(self, nblocks=10, blocksize=None, chunksize=None):
+        '''Get the statistics of all data sets (the columns except x) in one pass.
+
+        In the lazy mode the file is streamed in chunks and never loaded
+        into memory as a whole.
+
+        @para
+            nblocks: the number of blocks for the block averages
+            blocksize: the number of lines of a block, overrides nblocks
+            chunksize: the number of lines parsed at once, see :meth:`iter_chunks`
+        @return
+            a :class:`Statistics`, every field except n has one value per data set
+        '''
+        if self.nrows == 0:
+            raise ValueError("No datas in %s." % self.filename)
+        stats = RunningStatistics(blocksize or max(self.nrows // nblocks, 1))
+        for chunk in self.iter_chunks(chunksize):
+            stats.update(chunk[:, 1:])
+        return stats.result()
+
+    def _alter(self, column, func, vectorized):
+        '''Apply func to a whole column at once if it is vectorized, else value by value.'''
+        if vectorized:
+            op = func
+        else:
+            def op(values):
+                return numpy.fromiter(map(func, values), dtype=float, count=len(values))
+        self._apply_column(self.array[:, column], [op])
+        self._applied.setdefault(column, []).append(op)
+
+    def alter_x(self, func, vectorized=False):
         '''Alter the x values according the function func.
 
         @para
             func: a function
+            vectorized: if True func is called once with the whole column (an
+                array), else with each value; see also :meth:`transform`
         '''
-        self.x = list(map(func, self.x))
-        
-    def alter_y(self, func):
+        self._alter(0, func, vectorized)
+
+    def alter_y(self, func, vectorized=False):
         '''Alter the y values according the function func.
 
         @para
             func: a function
+            vectorized: if True func is called once with the whole column (an
+                array), else with each value; see also :meth:`transform`
         '''
-        self.y = list(map(func, self.y))
+        self._alter(1, func, vectorized)
+
+    def decimate(self, npoints=2000, method='minmax', column='y'):
+        '''Downsample the datas to about npoints rows, see :func:`decimate`.
+
+        In the lazy mode the file is streamed in chunks of whole bins and only
+        the reduced rows are kept, except for 'lttb' which needs all datas.
+
+        @para
+            npoints: the number of rows wanted
+            method: 'stride', 'mean', 'minmax' or 'lttb'
+            column: the data set used by 'minmax' and 'lttb', see :meth:`scale`
+        @return
+            a 2-D array
+        '''
+        column = self._column(column)
+        if self._array is not None or method == 'lttb':
+            return decimate(self.array, npoints, method, column)
+        if method not in ('stride', 'mean', 'minmax'):
+            raise ValueError("Unknown decimation method %r." % method)
+        binsize = _binsize(self.nrows, npoints, method)
+        chunksize = binsize * max(64 * self.index_stride // binsize, 1)
+        parts = [_decimate_bins(chunk, binsize, method, column) for chunk in self.iter_chunks(chunksize)]
+        return numpy.concatenate(parts) if parts else self.rows(0, 0)
+
+    def plot(self, columns=None, npoints=2000, method='minmax', ax=None, **kwargs):
+        '''Plot the data sets against x with matplotlib, downsampled by :meth:`decimate`.
+
+        @para
+            columns: the data sets to plot, all if None
+            npoints: the number of points plotted per data set
+            method: the decimation method
+            ax: the matplotlib axes, the current axes if None
+            kwargs: passed to ax.plot()
+        @return
+            the axes
+        '''
+        if ax is None:
+            from pylab import gca
+            ax = gca()
+        if columns is None:
+            columns = list(range(self.array.shape[1] - 1)) if self._array is not None else list(range(self._ncols - 1))
+        for name in columns:
+            column = self._column(name)
+            block = self.decimate(npoints, method, name)
+            label = self.legends[column - 1] if column - 1 < len(self.legends) else 's%d' % (column - 1)
+            ax.plot(block[:, 0], block[:, column], label=label, **kwargs)
+        return ax
+
+    def write(self, filename, fmt=None, chunksize=65536):
+        '''Write the header and the datas to a xvg file.
+
+        The ``#``/``@`` header lines are written back unchanged. The numeric
+        block is formatted *chunksize* rows at a time with a single string
+        formatting operation per chunk. A filename ending with ``.gz`` is
+        written with gzip.
+
+        @para
+            filename: the output file name
+            fmt: the format of a value, or a list with one format per column,
+                '%12.6f' for x and '%14.7g' for the data sets if None
+            chunksize: the number of rows formatted at once
+        '''
+        array = self.array
+        ncols = array.shape[1]
+        if fmt is None:
+            fmt = ['%12.6f'] + ['%14.7g'] * (ncols - 1)
+        elif isinstance(fmt, str):
+            fmt = [fmt] * ncols
+        if len(fmt) != ncols:
+            raise ValueError("%d formats are given for %d columns." % (len(fmt), ncols))
+        row = " ".join(fmt) + "\n"
+        with (gzip.open if filename.endswith('.gz') else open)(filename, 'wt') as xvg:
+            if self.header:
+                xvg.write("\n".join(self.header) + "\n")
+            for start in range(0, len(array), chunksize):
+                chunk = array[start:start + chunksize]
+                xvg.write((row * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+    @property
+    def x(self):
+        '''Get the x values, a view of the first column.'''
+        return self.array[:, 0]
+
+    @x.setter
+    def x(self, values):
+        self.array[:, 0] = values
+
+    @property
+    def y(self):
+        '''Get the y values, a view of the second column.'''
+        return self.array[:, 1]
+
+    @y.setter
+    def y(self, values):
+        self.array[:, 1] = values
 
     @property
     def average_y(self):
         '''Get the average value of the in y axis.'''
-        return sum(self.y) / len(self.y)
+        return self.y.mean()
 
     @property
     def data(self):
-        '''Get the x and y datas.'''
-        return [self.x, self.y]
+        '''Get the x and y datas, a view of the first two columns of :attr:`array`.'''
+        return self.array[:, :2].T
+
+
+#: the aligned datas of many xvg files, see :func:`read_many`
+Ensemble = namedtuple('Ensemble', ['filenames', 'x', 'stack', 'mean', 'std'])
+
+
+def _read_array(filename):
+    '''Read the array of a xvg file, the worker of :func:`read_many`.'''
+    return Xvg(filename).array
+
+
+def read_many(files, processes=None):
+    '''Read many xvg files in parallel and align them on the x axis.
+
+    The files, e.g. of replicas or umbrella windows, are parsed in a process
+    pool. Only the x values present in all files are kept, so runs of
+    different length are cut to their common part.
 
+    @para
+        files: a glob pattern or a list of filenames
+        processes: the number of processes, the number of CPUs if None
+    @return
+        a :class:`Ensemble`, whose stack has the shape (files, x, data sets),
+        mean and std are taken over the files.
+    '''
+    filenames = sorted(glob.glob(files)) if isinstance(files, str) else list(files)
+    if len(filenames) == 0:
+        raise ValueError("No xvg files in %r." % (files,))
+    if processes == 1 or len(filenames) == 1:
+        arrays = list(map(_read_array, filenames))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            arrays = pool.map(_read_array, filenames)
+    ncols = set(a.shape[1] for a in arrays)
+    if len(ncols) != 1:
+        raise Exception("The xvg files have different numbers of columns: %s." % sorted(ncols))
+    x = arrays[0][:, 0]
+    for a in arrays[1:]:
+        x = numpy.intersect1d(x, a[:, 0])
+    stack = numpy.stack([a[numpy.isin(a[:, 0], x), 1:] for a in arrays])
+    if stack.shape[1] != len(x):
+        raise Exception("The x values of some xvg files are not unique.")
+    return Ensemble(filenames, x, stack, stack.mean(axis=0), stack.std(axis=0))
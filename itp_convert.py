@@ -81,46 +81,54 @@ def main():
             for idx_new in equal_idx:
                 atoms_data[idx_new][5] = last_cgr + 1
 
+    # every section of a name, e.g. proper and improper [dihedrals] are separate sections
+    moleculetype = itp.header.moleculetype
+
     # [bonds]
-    for bond in itp.header.moleculetype.bonds.data:
-        old_idx0, old_idx1 = bond[0], bond[1]
-        idx0, idx1 = matches_dict[old_idx0], matches_dict[old_idx1]
-        bond[0] = min(idx0, idx1)
-        bond[1] = max(idx0, idx1)
-        bond[5] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1)
-    itp.header.moleculetype.bonds.data.sort()
+    for bonds in moleculetype.sections.getall('bonds'):
+        for bond in bonds.data:
+            old_idx0, old_idx1 = bond[0], bond[1]
+            idx0, idx1 = matches_dict[old_idx0], matches_dict[old_idx1]
+            bond[0] = min(idx0, idx1)
+            bond[1] = max(idx0, idx1)
+            bond[5] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1)
+        bonds.data.sort()
 
     # [pairs]
-    for pair in itp.header.moleculetype.pairs.data:
-        idx0, idx1 = matches_dict[pair[0]], matches_dict[pair[1]]
-        pair[0] = min(idx0, idx1)
-        pair[1] = max(idx0, idx1)
-    itp.header.moleculetype.pairs.data.sort()
+    for pairs in moleculetype.sections.getall('pairs'):
+        for pair in pairs.data:
+            idx0, idx1 = matches_dict[pair[0]], matches_dict[pair[1]]
+            pair[0] = min(idx0, idx1)
+            pair[1] = max(idx0, idx1)
+        pairs.data.sort()
 
     # [angles]
-    for angle in itp.header.moleculetype.angles.data:
-        old_idx0, old_idx1, old_idx2 = angle[0], angle[1], angle[2]
-        idx0, idx1, idx2 = matches_dict[angle[0]], matches_dict[angle[1]], matches_dict[angle[2]]
-        angle[0] = min(idx0, idx2)
-        angle[1] = idx1
-        angle[2] = max(idx0, idx2)
-        angle[6] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1) + ' ' + str(old_idx2)
-    itp.header.moleculetype.angles.set_data(sorted(itp.header.moleculetype.angles.data, key=lambda data: data[1]))
+    for angles in moleculetype.sections.getall('angles'):
+        for angle in angles.data:
+            old_idx0, old_idx1, old_idx2 = angle[0], angle[1], angle[2]
+            idx0, idx1, idx2 = matches_dict[angle[0]], matches_dict[angle[1]], matches_dict[angle[2]]
+            angle[0] = min(idx0, idx2)
+            angle[1] = idx1
+            angle[2] = max(idx0, idx2)
+            angle[6] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1) + ' ' + str(old_idx2)
+        angles.set_data(sorted(angles.data, key=lambda data: data[1]))
 
     # [dihedrals]
-    for dihedral in itp.header.moleculetype.dihedrals.data:
-        old_idx0, old_idx1, old_idx2, old_idx3 = dihedral[0], dihedral[1], dihedral[2], dihedral[3]
-        idx0, idx1, idx2, idx3 = matches_dict[dihedral[0]], matches_dict[dihedral[1]], matches_dict[dihedral[2]], matches_dict[dihedral[3]]
-        dihedral[0], dihedral[1], dihedral[2], dihedral[3] = idx0, idx1, idx2, idx3
-        dihedral[8] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1) + ' ' + str(old_idx2) + ' ' + str(old_idx3)
-    itp.header.moleculetype.dihedrals.set_data(sorted(itp.header.moleculetype.dihedrals.data, key=lambda data: data[1]))
+    for dihedrals in moleculetype.sections.getall('dihedrals'):
+        for dihedral in dihedrals.data:
+            old_idx0, old_idx1, old_idx2, old_idx3 = dihedral[0], dihedral[1], dihedral[2], dihedral[3]
+            idx0, idx1, idx2, idx3 = matches_dict[dihedral[0]], matches_dict[dihedral[1]], matches_dict[dihedral[2]], matches_dict[dihedral[3]]
+            dihedral[0], dihedral[1], dihedral[2], dihedral[3] = idx0, idx1, idx2, idx3
+            dihedral[8] = basename(args.output) + "  " + str(old_idx0) + ' ' + str(old_idx1) + ' ' + str(old_idx2) + ' ' + str(old_idx3)
+        dihedrals.set_data(sorted(dihedrals.data, key=lambda data: data[1]))
 
     # [exclusions]
-    for exclusion in itp.header.moleculetype.exclusions.data:
-        idx0, idx1 = matches_dict[exclusion[0]], matches_dict[exclusion[1]]
-        exclusion[0] = min(idx0, idx1)
-        exclusion[1] = max(idx0, idx1)
-    itp.header.moleculetype.exclusions.data.sort()
+    for exclusions in moleculetype.sections.getall('exclusions'):
+        for exclusion in exclusions.data:
+            idx0, idx1 = matches_dict[exclusion[0]], matches_dict[exclusion[1]]
+            exclusion[0] = min(idx0, idx1)
+            exclusion[1] = max(idx0, idx1)
+        exclusions.data.sort()
 
     # Write out
     itp.write(args.output)
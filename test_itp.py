@@ -0,0 +1,308 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from gromacs.fileformats.itp import ITP, Atoms, Bonds, Dihedrals, Pairs
+
+
+LIBRARY = """\
+; library with directives
+#define gb_1 0.1 1.5e7
+#define\tgb_2\t0.2 2.5e7 ; tab separated
+
+[ moleculetype ]
+; name nrexcl
+MOL 3
+
+[ atoms ]
+1 C 1 MOL C1 1 0.0 12.0
+2 C 1 MOL C2 1 0.0 12.0
+#ifdef HEAVY_H
+3 H 1 MOL H3 1 0.0 4.0
+#else
+3 H 1 MOL H3 1 0.0 1.0
+#endif
+
+[ bonds ]
+1 2 2 gb_1
+1 3 2 gb_2 ; macro
+
+#ifdef _NOT_DEFINED
+[ moleculetype ]
+HIDDEN 1
+[ atoms ]
+1 C 1 HID C1 1 0.0 12.0
+#endif
+
+[ moleculetype ]
+SOL 2
+
+[ atoms ]
+1 OW 1 SOL OW 1 -0.82 15.9994
+2 HW 1 SOL HW1 1 0.41 1.008
+3 HW 1 SOL HW2 1 0.41 1.008
+
+#ifndef FLEXIBLE
+[ settles ]
+1 1 0.1 0.16330
+
+[ exclusions ]
+1 2
+#else
+[ bonds ]
+1 2 1 0.1 345000
+1 3 1 0.1 345000
+#endif
+
+[ moleculetype ]
+NA 1
+
+[ atoms ]
+1 NA 1 NA NA 1 1.0 22.99
+"""
+
+
+class TestMoleculeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = self.write('lib.itp', LIBRARY)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_index(self):
+        molecules = ITP(self.filename, lazy=True).molecules
+        self.assertListEqual(list(molecules), ['MOL', 'SOL', 'NA'])     # HIDDEN is in an inactive branch
+        self.assertNotIn('HIDDEN', molecules)
+        self.assertRaises(KeyError, molecules.__getitem__, 'HIDDEN')
+        self.assertEqual(molecules['NA'].data['nrexcl'], 1)
+        self.assertListEqual(molecules['NA'].atoms.data['charge'].tolist(), [1.0])
+
+    def test_directives(self):
+        molecules = ITP(self.filename, lazy=True).molecules
+        self.assertListEqual(molecules['MOL'].atoms.data['mass'].tolist(), [12.0, 12.0, 1.0])
+        self.assertListEqual(molecules['SOL'].sections.keys(), ['atoms', 'settles', 'exclusions'])
+        self.assertListEqual(molecules['SOL'].exclusions.data.tolist(), [(1, 2, '')])
+
+        molecules = ITP(self.filename, lazy=True, FLEXIBLE=True, HEAVY_H=True).molecules
+        self.assertListEqual(molecules['MOL'].atoms.data['mass'].tolist(), [12.0, 12.0, 4.0])
+        self.assertListEqual(molecules['SOL'].sections.keys(), ['atoms', 'bonds'])
+        self.assertListEqual(molecules['SOL'].bonds.data.tolist(),
+                             [(1, 2, 1, 0.1, 345000.0, ''), (1, 3, 1, 0.1, 345000.0, '')])
+
+    def test_macros(self):
+        molecules = ITP(self.filename, lazy=True).molecules
+        self.assertListEqual(molecules['MOL'].bonds.data.tolist(),
+                             [(1, 2, 2, 0.1, 1.5e7, ''), (1, 3, 2, 0.2, 2.5e7, 'macro')])
+
+    def test_duplicate_names(self):
+        filename = self.write('dup.itp', LIBRARY + LIBRARY.split('#ifdef _NOT_DEFINED')[0].replace('12.0', '13.0'))
+        molecules = ITP(filename, lazy=True).molecules
+        self.assertListEqual(list(molecules), ['SOL', 'NA', 'MOL'])
+        self.assertListEqual(molecules['MOL'].atoms.data['mass'].tolist(), [13.0, 13.0, 1.0])
+
+    def test_without_directives(self):
+        text = "\n".join(line for line in LIBRARY.splitlines() if not line.startswith('#'))
+        filename = self.write('plain.itp', text.replace('gb_1', '0.1 1.5e7').replace('gb_2', '0.2 2.5e7'))
+        molecules = ITP(filename, lazy=True).molecules
+        self.assertListEqual(list(molecules), ['MOL', 'HIDDEN', 'SOL', 'NA'])
+        self.assertListEqual(molecules['SOL'].sections.keys(), ['atoms', 'settles', 'exclusions', 'bonds'])
+
+    def test_syntax_errors(self):
+        filename = self.write('bad.itp', LIBRARY + "#ifdef POSRES\n")
+        self.assertRaises(SyntaxError, lambda: ITP(filename, lazy=True).molecules)
+        filename = self.write('bad.itp', LIBRARY + "#if POSRES\n#endif\n")
+        self.assertRaises(SyntaxError, lambda: ITP(filename, lazy=True).molecules)
+
+
+def parse_section(cls, lines):
+    section = cls(ITP())
+    for line in lines:
+        section.process(line)
+    return section
+
+
+def rowwise_recarray(section):
+    """The recarray of *section* built record by record, as before the columnar conversion."""
+    nmax = max(len(record) for record, comment in section._canonical_records())
+    a = numpy.recarray((len(section._canonical_records()),), dtype=section.dtypes[:nmax] + [("comment", "U128")])
+    return section._fill_recarray(a, nmax)
+
+
+class TestCreateRecarray(unittest.TestCase):
+
+    def assertSameRecarray(self, section):
+        expected = rowwise_recarray(section)
+        result = section._create_recarray()
+        self.assertEqual(result.dtype, expected.dtype)
+        for name in expected.dtype.names:
+            if expected.dtype[name].kind == 'O':
+                self.assertListEqual(result[name].tolist(), expected[name].tolist())
+            else:
+                numpy.testing.assert_array_equal(result[name], expected[name], err_msg=name)
+
+    def assertSameError(self, section):
+        with self.assertRaises((ValueError, TypeError, OverflowError)) as expected:
+            rowwise_recarray(section)
+        with self.assertRaises(type(expected.exception)):
+            section._create_recarray()
+
+    def test_ragged_records(self):
+        # missing float (mass, chargeB, massB) and str (atomtypeB) columns
+        self.assertSameRecarray(parse_section(Atoms, [
+            "1 opls_145 1 5FH C7 7 -0.115 12.011 ; CA # Benzene C",
+            "2 opls_146 1 5FH H71 7 0.115",
+            "3 opls_146 1 5FH H72 7 0.115 1.008 opls_147 0.2 2.016",
+            "4 opls_146 1 5FH H73 7 0.115 1.008 opls_147",
+        ]))
+        self.assertSameRecarray(parse_section(Bonds, ["1 2 1", "1 3 1 0.1 1e5 ; comment", "2 3 2 0.2"]))
+
+    def test_object_columns(self):
+        # missing object columns are None
+        self.assertSameRecarray(parse_section(Dihedrals, [
+            "1 2 3 4 3 ; HA-CA-CA-HA",
+            "1 2 3 5 9 0.0 4.6 2",
+            "1 2 3 6 3 30.334 0.0 -30.334 0.0 0.0 0.0",
+        ]))
+
+    def test_empty(self):
+        self.assertEqual(len(parse_section(Bonds, []).data), 0)
+
+    def test_fallback_errors(self):
+        self.assertSameError(parse_section(Bonds, ["1 2 1", "x 3 1"]))            # not a number
+        self.assertSameError(parse_section(Bonds, ["1 2 1", "1 3"]))              # missing int column
+        self.assertSameError(parse_section(Pairs, ["1 2 1", "1 3 1 0.5"]))       # more columns than dtypes
+        self.assertSameError(parse_section(Pairs, ["1 2 99999999999"]))           # out of bounds
+
+
+def rowwise_section(section):
+    """The text of *section* formatted record by record, as before section_chunks()."""
+    lines = ["[ %s ]" % section.name, section.column_comment]
+    lines.extend(section._section_lines())
+    return "\n".join(lines) + "\n"
+
+
+class TestSectionChunks(unittest.TestCase):
+
+    SECTIONS = [
+        (Atoms, ["1 opls_145 1 5FH C7 7 -0.115 12.011 ; CA # Benzene C",
+                 "2 opls_146 1 5FH H71 7 0.115 1.008",
+                 "3 opls_146 1 5FH H72 7 0.115 1.008 opls_147 0.2 2.016",
+                 "4 opls_146 1 5FH H73 7 0.115 1.008 opls_147 ; B state"]),
+        (Bonds, ["%d %d 1 0.1 1e5%s" % (i, i + 1, " ; c%d" % i if i % 3 else "") for i in range(1, 30)] + ["1 3 5"]),
+        (Dihedrals, ["1 2 3 4 3 ; HA-CA-CA-HA", "1 2 3 5 9 0.0 4.6 2", "1 2 3 6 3 30.334 0.0 -30.334 0.0 0.0 0.0"]),
+        (Pairs, []),
+    ]
+
+    def test_same_as_rowwise(self):
+        for cls, lines in self.SECTIONS:
+            section = parse_section(cls, lines)
+            section.chunkrows = 4
+            self.assertEqual("".join(section.section_chunks()), rowwise_section(section), cls.name)
+            self.assertEqual(section.section(), rowwise_section(section), cls.name)
+
+    def test_same_error(self):
+        # a missing mass before the B state columns can not be written
+        section = parse_section(Atoms, ["1 opls_145 1 5FH C7 7 -0.115 12.011 opls_147",
+                                        "2 opls_146 1 5FH H71 7 0.115"])
+        self.assertRaises(TypeError, rowwise_section, section)
+        self.assertRaises(TypeError, section.section)
+
+    def test_changed_data(self):
+        for cls, lines in self.SECTIONS[:3]:
+            section = parse_section(cls, lines)
+            section.data[0]['ai' if 'ai' in section.data.dtype.names else 'atomnr'] = 99
+            self.assertEqual(section.section(), rowwise_section(section), cls.name)
+            # a list of records instead of the recarray
+            section.set_data(sorted(section.data, key=lambda record: -record[0]))
+            self.assertEqual(section.section(), rowwise_section(section), cls.name)
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mol.itp')
+            with open(filename, 'w') as f:
+                f.write("; molecule\n[ moleculetype ]\nMOL 3\n[ atoms ]\n" + "\n".join(self.SECTIONS[0][1]) +
+                        "\n[ bonds ]\n" + "\n".join(self.SECTIONS[1][1]) + "\n")
+            itp = ITP(filename)
+            itp.write(os.path.join(tmpdir, 'out.itp'))
+            with open(os.path.join(tmpdir, 'out.itp')) as f:
+                self.assertEqual(f.read(), str(itp))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+MOLECULE = """\
+; molecule with propers and impropers
+[ moleculetype ]
+; Name nrexcl
+MOL 3
+
+[ atoms ]
+1 CA 1 MOL C1 1 0.0 12.011
+2 CA 1 MOL C2 1 0.0 12.011
+3 CA 1 MOL C3 1 0.0 12.011
+4 HA 1 MOL H4 1 0.0 1.008
+
+[ dihedrals ]
+1 2 3 4 3 ; proper
+
+[ pairs ]
+1 4 1
+
+[ dihedrals ]
+1 2 3 4 1 180.0 4.6 2 ; improper
+
+[ dihedrals ]
+2 1 3 4 4 ; second improper
+"""
+
+
+class TestRepeatedSections(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'mol.itp')
+        with open(self.filename, 'w') as f:
+            f.write(MOLECULE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSections(self, itp):
+        molecule = itp.header.moleculetype
+        self.assertListEqual(molecule.sections.keys(), ['atoms', 'dihedrals', 'pairs', 'dihedrals', 'dihedrals'])
+        dihedrals = molecule.sections.getall('dihedrals')
+        self.assertListEqual([d.data['comment'].tolist() for d in dihedrals],
+                             [['proper'], ['improper'], ['second improper']])
+        self.assertTupleEqual(dihedrals[1].data.tolist()[0][:8], (1, 2, 3, 4, 1, '180.0', '4.6', '2'))
+        self.assertIs(molecule.dihedrals, dihedrals[-1])
+
+    def test_read(self):
+        self.assertSections(ITP(self.filename))
+
+    def test_write(self):
+        itp = ITP(self.filename)
+        out = os.path.join(self.tmpdir, 'out.itp')
+        itp.write(out)
+        self.assertSections(ITP(out))
+        itp.header.moleculetype.sections.getall('dihedrals')[0].data['func'] = 9
+        itp.write(out)
+        copy = ITP(out)
+        self.assertSections(copy)
+        self.assertListEqual([d.data['func'].tolist() for d in copy.header.moleculetype.sections.getall('dihedrals')],
+                             [[9], [1], [4]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+from gromacs.fileformats.ndx import NDX, IndexSet, IndexRanges, RangeSet, uniqueNDX, _LazyGroup
+
+
+class TestNDXSave(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.ndx')
+        ndx = NDX()
+        ndx['System'] = numpy.arange(1, 1001)
+        ndx['Protein'] = numpy.arange(1, 101)
+        ndx['SOL'] = numpy.arange(101, 1001)
+        ndx.append('SOL', numpy.arange(101, 201))     # duplicate group
+        ndx['OW'] = numpy.arange(101, 1001, 3)
+        ndx.write(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSaved(self, ndx, filename=None):
+        """save() must write the same file as write() and read back the same groups."""
+        ndx.save(filename)
+        expected = os.path.join(self.tmpdir, 'expected.ndx')
+        ndx.write(expected)
+        with open(filename or self.path, 'rb') as saved, open(expected, 'rb') as written:
+            self.assertEqual(saved.read(), written.read())
+        reread = NDX(filename or self.path)
+        self.assertListEqual(reread.all_groups, ndx.all_groups)
+        for nr, name in enumerate(ndx.all_groups):
+            numpy.testing.assert_array_equal(reread._load(nr), ndx._load(nr))
+
+    def test_save_unchanged(self):
+        self.assertSaved(NDX(self.path))
+
+    def test_save_after_append(self):
+        ndx = NDX(self.path)
+        with open(self.path, 'rb') as f:
+            original = f.read()
+        ndx['New'] = [5, 7, 9]
+        ndx.append('OW', [2, 4])
+        self.assertSaved(ndx)
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read().startswith(original))
+        ndx['Other'] = [11, 12]
+        self.assertSaved(ndx)
+
+    def test_save_after_replacement(self):
+        ndx = NDX(self.path)
+        ndx['Protein'] = numpy.arange(1, 51)
+        ndx['SOL'] = [500, 600]         # the last of the duplicates
+        self.assertSaved(ndx)
+        self.assertEqual(len(NDX(self.path).get_all('SOL')[0]), 900)
+
+    def test_save_after_deletion(self):
+        ndx = NDX(self.path)
+        del ndx['Protein']
+        self.assertSaved(ndx)
+        del ndx['SOL']
+        ndx['New'] = [1, 2, 3]
+        self.assertSaved(ndx)
+        self.assertNotIn('SOL', NDX(self.path))
+
+    def test_save_lazy(self):
+        ndx = NDX(self.path, lazy=True)
+        ndx['Protein'] = [1, 2, 3]
+        del ndx['OW']
+        ndx['New'] = [4, 5]
+        self.assertSaved(ndx)
+
+    def test_save_to_other_file(self):
+        ndx = NDX(self.path)
+        ndx['New'] = [4, 5]
+        with open(self.path, 'rb') as f:
+            original = f.read()
+        self.assertSaved(ndx, os.path.join(self.tmpdir, 'other.ndx'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_save_after_change_on_disk(self):
+        ndx = NDX(self.path)
+        with open(self.path, 'a') as f:
+            f.write('[ Foreign ]\n1 2 3\n')
+        ndx['New'] = [4, 5]
+        self.assertSaved(ndx)
+        self.assertNotIn('Foreign', NDX(self.path))
+
+
+class TestAddGroupsOfAtomsInRes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.ndx')
+        ndx = NDX()
+        ndx['SOL'] = numpy.arange(101, 131)     # 10 waters
+        ndx.write(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_specs(self):
+        ndx = NDX(self.path)
+        specs = [('OW', 'SOL', numpy.int64(3), [0]), ('HW', 'SOL', 3, [1, 2], 2),
+                 ('Ions', 'NA', 1, [0]), ('X', 'SOL', 3, [0]), ('Empty', 'SOL', 3, []), ('Half', 'SOL', 1.5, [0])]
+        with self.assertLogs('gromacs.fileformats.ndx', 'WARNING') as logs:
+            self.assertListEqual(ndx.add_groups_of_atoms_in_res(specs), ['OW', 'HW'])
+        self.assertEqual(len(logs.records), 4)
+        self.assertIn("'Ions'", logs.output[0])
+        ndx = NDX(self.path)
+        numpy.testing.assert_array_equal(ndx['OW'], numpy.arange(101, 131, 3))
+        numpy.testing.assert_array_equal(ndx['HW'], [102, 103, 105, 106])
+
+    def test_script_spec_errors(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'add_group_to_ndx.py')
+        spec_file = os.path.join(self.tmpdir, 'specs.txt')
+        for line in ('OW SOL 3 "0"', 'OW SOL three "0" 0', 'OW SOL 3 "0 0'):
+            with open(spec_file, 'w') as f:
+                f.write('# group res num atoms num_mols\n\n' + line + '\n')
+            result = subprocess.run([sys.executable, script, '--batch', spec_file, self.path],
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertTrue(result.stdout.startswith(spec_file + ':3: invalid spec'), result.stdout)
+
+
+class TestNDXBinary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.ndxb')
+        self.ndx = NDX()
+        self.ndx['System'] = numpy.arange(1, 1001)
+        self.ndx['SOL'] = numpy.arange(101, 1001)
+        self.ndx.append('SOL', numpy.arange(101, 201))     # duplicate group
+        self.ndx['OW'] = numpy.arange(101, 1001, 3)
+        self.ndx.write_binary(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        for lazy in (False, True):
+            ndx = NDX(self.path, lazy=lazy)
+            self.assertListEqual(ndx.all_groups, self.ndx.all_groups)
+            self.assertEqual(ndx.real_filename, os.path.join(self.tmpdir, 'index.ndx'))
+            for nr in range(len(self.ndx.all_groups)):
+                numpy.testing.assert_array_equal(ndx._load(nr), self.ndx._load(nr))
+
+    def test_lazy(self):
+        ndx = NDX(self.path, lazy=True)
+        self.assertTrue(all(isinstance(group[1], _LazyGroup) for group in ndx._store))
+        self.assertDictEqual(ndx.sizes, self.ndx.sizes)
+        numpy.testing.assert_array_equal(ndx['SOL'], numpy.arange(101, 201))
+        self.assertListEqual([isinstance(group[1], _LazyGroup) for group in ndx._store], [True, True, False, True])
+        numpy.testing.assert_array_equal(ndx.get_all('SOL')[0], numpy.arange(101, 1001))
+
+
+class TestReverseIndex(unittest.TestCase):
+
+    def setUp(self):
+        ndx = NDX()
+        ndx['System'] = numpy.arange(1, 21)
+        ndx['SOL'] = numpy.arange(11, 21)
+        ndx['Protein'] = numpy.arange(1, 11)
+        ndx.append('SOL', [11, 12])         # duplicate group
+        self.reverse = ndx.reverse_index()
+
+    def test_contains(self):
+        self.assertTrue(self.reverse.contains(15, 'SOL'))       # only in the first SOL
+        self.assertTrue(self.reverse.contains(11, 'SOL'))
+        self.assertFalse(self.reverse.contains(5, 'SOL'))
+        self.assertTrue(self.reverse.contains(15, 1))
+        self.assertFalse(self.reverse.contains(15, 3))
+        self.assertFalse(self.reverse.contains(50, 'System'))
+        self.assertRaises(KeyError, self.reverse.contains, 1, 'Ions')
+        self.assertRaises(KeyError, self.reverse.contains, 1, 4)
+
+    def test_groups_of_and_classify(self):
+        self.assertListEqual(self.reverse.groups_of(15), ['System', 'SOL'])
+        self.assertListEqual(self.reverse.groups_of(11), ['System', 'SOL', 'SOL'])
+        self.assertListEqual(self.reverse.groups_of(0), [])
+        member = self.reverse.classify([1, 12, 99])
+        self.assertListEqual(member.tolist(), [[True, False, True, False], [True, True, False, True],
+                                               [False, False, False, False]])
+        for atom in range(25):
+            for name in ('System', 'SOL', 'Protein'):
+                self.assertEqual(self.reverse.contains(atom, name), name in self.reverse.groups_of(atom))
+
+
+class TestIndexSet(unittest.TestCase):
+
+    def test_set_semantics(self):
+        a, b = IndexSet([3, 1, 2, 3]), IndexSet({1, 2, 3, 4})
+        self.assertEqual(a.tolist(), [1, 2, 3])
+        self.assertTrue(a == IndexSet([1, 2, 3]) and a == {1, 2, 3} and a != b)
+        self.assertFalse(a == [1, 2, 3])
+        self.assertTrue(a <= b and a < b and b >= a and b > a and not b <= a and not a < a)
+        self.assertTrue(a.issubset(b) and b.issuperset(a) and not b.issubset(a))
+        self.assertTrue(a.isdisjoint([5, 6]) and not a.isdisjoint(b))
+        self.assertTrue(bool(a))
+        self.assertFalse(bool(IndexSet()))
+        self.assertEqual((a + [7]).tolist(), [1, 2, 3, 7])
+        self.assertEqual((b - [2, 4, 9]).tolist(), [2, 4])
+        self.assertEqual(b.difference(a).tolist(), [4])
+        self.assertIn(2, a)
+        self.assertNotIn(4, a)
+
+    def test_unique_groups_are_copies(self):
+        ndx = uniqueNDX()
+        ndx['A'] = [3, 1, 2]
+        ndx['B'] = ndx['A']
+        self.assertIsNot(ndx['A'], ndx['B'])
+        ndx['B'][0] = 10
+        self.assertEqual(ndx['A'].tolist(), [1, 2, 3])
+
+
+class TestIndexRanges(unittest.TestCase):
+
+    def test_indexing(self):
+        rng = numpy.random.RandomState(7)
+        for i in range(50):
+            atoms = numpy.flatnonzero(numpy.cumsum(rng.randint(-1, 2, 60)) > 0) + 1
+            ranges = IndexRanges.encode(atoms, 1)
+            if not len(atoms):
+                continue
+            self.assertEqual(len(ranges), len(atoms))
+            self.assertListEqual([ranges[k] for k in range(-len(atoms), len(atoms))], atoms.tolist() + atoms.tolist())
+            for key in (slice(None), slice(3, -2), slice(None, None, 2), slice(-1, 2, -3), slice(5, 5)):
+                numpy.testing.assert_array_equal(ranges[key], atoms[key])
+            numpy.testing.assert_array_equal(ranges[atoms % 2 == 0], atoms[atoms % 2 == 0])
+            self.assertRaises(IndexError, ranges.__getitem__, len(atoms))
+            self.assertRaises(IndexError, ranges.__getitem__, -len(atoms) - 1)
+
+    def test_read_only(self):
+        ndx = NDX()
+        ndx.min_run = 4
+        ndx['SOL'] = numpy.arange(1, 101)
+        sol = ndx['SOL']
+        self.assertIsInstance(sol, IndexRanges)
+        self.assertRaises(TypeError, sol.__setitem__, 0, 5)
+        self.assertRaises(TypeError, lambda: sol.sort())
+        ndx['SOL'] += 1
+        numpy.testing.assert_array_equal(ndx['SOL'], numpy.arange(2, 102))
+        self.assertEqual((numpy.min(sol), numpy.max(sol)), (1, 100))
+        self.assertIsInstance(NDX()._transform(numpy.arange(1, 101)), numpy.ndarray)   # runs are opt-in
+
+
+class TestRangeSet(unittest.TestCase):
+
+    def sets(self):
+        """Pairs of atom number arrays with runs, gaps, touching and empty sets."""
+        rng = numpy.random.RandomState(42)
+        arrays = [numpy.zeros(0, dtype=int), numpy.arange(1, 11), numpy.arange(11, 21), numpy.arange(5, 15),
+                  numpy.array([3]), numpy.r_[1:5, 8:9, 20:40]]
+        for i in range(20):
+            arrays.append(numpy.flatnonzero(numpy.cumsum(rng.randint(-1, 2, 300)) > 0) + 1)
+        for a in arrays:
+            for b in arrays:
+                yield a, b
+
+    def test_set_operations(self):
+        for a, b in self.sets():
+            ranges_a, ranges_b = RangeSet.encode(IndexSet(a), 1), RangeSet.encode(IndexSet(b), 1)
+            if not len(a) or not len(b):
+                continue                # empty sets are not encoded
+            for op in ('union', 'intersection', 'difference'):
+                expected = getattr(IndexSet(a), op)(IndexSet(b))
+                result = getattr(ranges_a, op)(ranges_b)
+                self.assertIsInstance(result, RangeSet)
+                numpy.testing.assert_array_equal(numpy.asarray(result), numpy.asarray(expected), err_msg=op)
+                # a plain array as the other operand
+                numpy.testing.assert_array_equal(numpy.asarray(getattr(ranges_a, op)(b)), numpy.asarray(expected),
+                                              err_msg=op)
+
+    def test_operators(self):
+        a, b = RangeSet.encode(IndexSet(numpy.arange(1, 21)), 1), RangeSet.encode(IndexSet(numpy.arange(11, 31)), 1)
+        numpy.testing.assert_array_equal(numpy.asarray(a + b), numpy.arange(1, 31))
+        numpy.testing.assert_array_equal(numpy.asarray(a | b), numpy.arange(1, 31))
+        numpy.testing.assert_array_equal(numpy.asarray(a - b), numpy.arange(11, 21))
+        numpy.testing.assert_array_equal(numpy.asarray(a & b), numpy.arange(11, 21))
+
+    def test_contains_min_max(self):
+        a = RangeSet.encode(IndexSet(numpy.r_[3:8, 12:20]), 1)
+        self.assertEqual([x for x in range(25) if x in a], list(range(3, 8)) + list(range(12, 20)))
+        self.assertEqual((a.min(), a.max()), (3, 19))
+        self.assertEqual((numpy.min(a), numpy.max(a)), (3, 19))
+        self.assertEqual(len(a), 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import numpy
+
+from gromacs.fileformats.ndx import NDX, uniqueNDX
+from gromacs.fileformats.selection import Selection, select
+
+
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        # residue 1: protein (atoms 1-4), residues 2-4: water (atoms 5-13)
+        self.atoms = numpy.array(
+            [('N', 1, 'ALA'), ('CA', 1, 'ALA'), ('C', 1, 'ALA'), ('O', 1, 'ALA')] +
+            [(name, resnr, 'SOL') for resnr in (2, 3, 4) for name in ('OW', 'HW1', 'HW2')],
+            dtype=[('atomname', 'U4'), ('resnr', 'i4'), ('resname', 'U4')])
+        self.ndx = NDX()
+        self.ndx['System'] = numpy.arange(1, 14)
+        self.ndx['Protein'] = [1, 2, 3, 4]
+        self.ndx['SOL'] = numpy.arange(5, 14)
+        self.ndx['Water and ions'] = numpy.arange(5, 14)
+        self.ndx.append('SOL', [5, 6, 7])         # a duplicate name
+
+    def select(self, expression):
+        return select(self.ndx, expression, self.atoms).tolist()
+
+    def test_plan_and_precedence(self):
+        # '!' binds tighter than '&', which binds tighter than '|'
+        self.assertEqual(Selection('A | B & !C').plan,
+                         ('or', ('group', 'A'), ('and', ('group', 'B'), ('not', ('group', 'C')))))
+        self.assertEqual(Selection('(A | B) & C').plan,
+                         ('and', ('or', ('group', 'A'), ('group', 'B')), ('group', 'C')))
+        self.assertEqual(Selection('!!A').plan, ('not', ('not', ('group', 'A'))))
+        self.assertEqual(Selection('2 & a 1-3 7').plan, ('and', ('groupnr', 2), ('atomnr', [(1, 3), (7, 7)])))
+        self.assertEqual(self.select('Protein | System & a OW'), [1, 2, 3, 4, 5, 8, 11])
+        self.assertEqual(self.select('(Protein | System) & a OW'), [5, 8, 11])
+        self.assertEqual(self.select('!Protein & !a OW'), [6, 7, 9, 10, 12, 13])
+
+    def test_cache(self):
+        self.assertIs(Selection('SOL & a OW'), Selection('SOL & a OW'))
+
+    def test_groups(self):
+        self.assertEqual(self.select('"Water and ions" & r 3'), [8, 9, 10])
+        self.assertEqual(self.select('SOL'), [5, 6, 7])            # the last group of the name
+        # group numbers count from 0 and include the duplicates
+        self.assertEqual(self.select('1'), [1, 2, 3, 4])
+        self.assertEqual(self.select('2'), list(range(5, 14)))     # first SOL
+        self.assertEqual(self.select('4'), [5, 6, 7])              # second SOL
+        self.assertRaises(KeyError, self.select, '5')
+        self.assertRaises(KeyError, self.select, 'Ions')
+
+    def test_atoms_and_residues(self):
+        self.assertEqual(self.select('a 1-3 12'), [1, 2, 3, 12])
+        self.assertEqual(self.select('a OW C'), [3, 5, 8, 11])
+        self.assertEqual(self.select('a HW*'), [6, 7, 9, 10, 12, 13])
+        self.assertEqual(self.select('r 2-3'), [5, 6, 7, 8, 9, 10])
+        self.assertEqual(self.select('r AL* & a C*'), [2, 3])
+        self.assertEqual(self.select('r SOL & !r 2 4'), [8, 9, 10])
+        self.assertRaises(ValueError, select, self.ndx, 'a OW')     # no atoms table
+
+    def test_without_atoms(self):
+        ndx = uniqueNDX()
+        ndx['A'] = [3, 1, 2]
+        ndx['B'] = [2, 5]
+        self.assertEqual(select(ndx, '!A').tolist(), [4, 5])
+        self.assertEqual(ndx.select('A | a 7-8').tolist(), [1, 2, 3, 7, 8])
+
+    def test_syntax_errors(self):
+        for expression in ['', 'SOL &', 'SOL | | Protein', '(SOL', 'SOL)', 'a', 'r 1 SOL', '"SOL', 'SOL Protein']:
+            self.assertRaises(SyntaxError, Selection, expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
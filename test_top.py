@@ -0,0 +1,210 @@
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+from gromacs.fileformats.top import TOP, TopologyFile
+
+
+FORCEFIELD = """\
+#define _FF_TEST
+[ defaults ]
+1 1 no 1.0 1.0
+#include "ffbonded.itp"
+"""
+
+FFBONDED = """\
+; GROMOS style macros
+#define gb_1        0.1000  1.5700e+07
+#define\tgb_2\t0.1100\t1.2300e+07 ; tab separated
+"""
+
+SPC = """\
+[ moleculetype ]
+; molname nrexcl
+SOL 2
+
+[ atoms ]
+1 OW 1 SOL OW 1 -0.82 15.9994
+2 HW 1 SOL HW1 1 0.41 1.008
+#ifdef HEAVY_H
+3 HW 1 SOL HW2 1 0.41 4.032
+#else
+3 HW 1 SOL HW2 1 0.41 1.008
+#endif
+
+#ifndef FLEXIBLE
+[ settles ]
+1 1 0.1 0.16330
+#else
+[ bonds ]
+1 2 2 gb_1
+1 3 2 gb_2 ; second
+#endif
+"""
+
+TOPOL = """\
+; topology
+#include "ff.ff/forcefield.itp"
+#ifdef _FF_TEST
+[ moleculetype ]
+MOL 3
+#else
+[ moleculetype ]
+WRONG 3
+#endif
+
+[ atoms ]
+1 C 1 MOL C1 1 0.0 12.0
+2 C 1 MOL C2 1 0.0 12.0
+
+[ bonds ]
+1 2 2 gb_1 ; macro
+
+#ifdef POSRES
+#include "posre.itp"
+#endif
+
+#include "ff.ff/spc.itp"
+
+[ system ]
+Test system
+
+[ molecules ]
+MOL 1
+SOL 10
+"""
+
+POSRE = """\
+[ position_restraints ]
+1 1 1000 1000 1000
+"""
+
+
+class TestTOP(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gmxlib = os.environ.pop('GMXLIB', None)
+        self.gmxdata = os.environ.pop('GMXDATA', None)
+        TopologyFile.clear_cache()
+        self.write('ff.ff/forcefield.itp', FORCEFIELD)
+        self.write('ff.ff/ffbonded.itp', FFBONDED)
+        self.write('ff.ff/spc.itp', SPC)
+        self.write('posre.itp', POSRE)
+        self.topol = self.write('topol.top', TOPOL)
+
+    def tearDown(self):
+        for var, value in (('GMXLIB', self.gmxlib), ('GMXDATA', self.gmxdata)):
+            os.environ.pop(var, None)
+            if value is not None:
+                os.environ[var] = value
+        TopologyFile.clear_cache()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(text))
+        return path
+
+    def path(self, name):
+        return os.path.realpath(os.path.join(self.tmpdir, name))
+
+    def test_sections(self):
+        top = TOP(self.topol)
+        self.assertListEqual(top.sections.keys(), ['defaults', 'moleculetype', 'atoms', 'bonds',
+                                                   'moleculetype', 'atoms', 'settles', 'system', 'molecules'])
+        self.assertListEqual(top.system.data, ['Test system'])
+        self.assertListEqual(top.molecules.data.tolist(), [('MOL', 1, ''), ('SOL', 10, '')])
+        self.assertListEqual(top.files, [self.path('topol.top'), self.path('ff.ff/forcefield.itp'),
+                                         self.path('ff.ff/ffbonded.itp'), self.path('ff.ff/spc.itp')])
+
+    def test_define_from_include(self):
+        # _FF_TEST is defined in forcefield.itp and tested in topol.top
+        top = TOP(self.topol)
+        self.assertListEqual(list(top.moleculetypes), ['MOL', 'SOL'])
+
+    def test_ifdef_ifndef_else(self):
+        top = TOP(self.topol)
+        sol = top.moleculetypes['SOL']
+        self.assertListEqual(sol.sections.keys(), ['atoms', 'settles'])
+        self.assertListEqual(sol.atoms.data['mass'].tolist(), [15.9994, 1.008, 1.008])
+
+        top = TOP(self.topol, FLEXIBLE=True, HEAVY_H=True)
+        sol = top.moleculetypes['SOL']
+        self.assertListEqual(sol.sections.keys(), ['atoms', 'bonds'])
+        self.assertListEqual(sol.atoms.data['mass'].tolist(), [15.9994, 1.008, 4.032])
+
+        # keywords of read() modify the defines of the constructor
+        top.read(FLEXIBLE=False)
+        self.assertListEqual(top.moleculetypes['SOL'].sections.keys(), ['atoms', 'settles'])
+
+    def test_macros(self):
+        top = TOP(self.topol, FLEXIBLE=True)
+        bonds = top.moleculetypes['MOL'].bonds.data.tolist()
+        self.assertListEqual(bonds, [(1, 2, 2, 0.1, 1.57e7, 'macro')])
+        bonds = top.moleculetypes['SOL'].bonds.data.tolist()
+        self.assertListEqual(bonds, [(1, 2, 2, 0.1, 1.57e7, ''), (1, 3, 2, 0.11, 1.23e7, 'second')])
+
+    def test_define_value_from_keyword(self):
+        self.write('ff.ff/ffbonded.itp', "; no macros\n")
+        top = TOP(self.topol, gb_1="0.2 1000")
+        self.assertListEqual(top.moleculetypes['MOL'].bonds.data.tolist(), [(1, 2, 2, 0.2, 1000.0, 'macro')])
+
+    def test_posres(self):
+        top = TOP(self.topol, POSRES=True)
+        self.assertIn(self.path('posre.itp'), top.files)
+        self.assertListEqual(top.moleculetypes['MOL'].sections.keys(), ['atoms', 'bonds', 'position_restraints'])
+        self.assertListEqual(top.moleculetypes['SOL'].sections.keys(), ['atoms', 'settles'])
+
+    def test_include_search_order(self):
+        incdir, gmxlib = os.path.join(self.tmpdir, 'inc'), os.path.join(self.tmpdir, 'lib')
+        self.write('inc/posre.itp', POSRE)
+        self.write('lib/posre.itp', POSRE)
+        self.write('lib/extra.itp', POSRE)
+        os.environ['GMXLIB'] = gmxlib
+        top = TOP(self.topol, includedirs=[incdir], POSRES=True)
+        self.assertIn(self.path('posre.itp'), top.files)          # directory of the including file
+
+        os.remove(os.path.join(self.tmpdir, 'posre.itp'))
+        top = TOP(self.topol, includedirs=[incdir], POSRES=True)
+        self.assertIn(self.path('inc/posre.itp'), top.files)      # includedirs
+
+        top = TOP(self.topol, POSRES=True)
+        self.assertIn(self.path('lib/posre.itp'), top.files)      # GMXLIB
+
+        del os.environ['GMXLIB']
+        self.assertRaises(IOError, TOP, self.topol, POSRES=True)
+
+    def test_cache(self):
+        top1 = TOP(self.topol)
+        top2 = TOP(self.topol)
+        spc = TopologyFile.load(self.path('ff.ff/spc.itp'))
+        self.assertIs(TopologyFile.load(self.path('ff.ff/spc.itp')), spc)
+        self.assertIs(top1.moleculetypes['MOL'].atoms, top2.moleculetypes['MOL'].atoms)
+        # the section split by #ifdef/#else/#endif is also kept
+        self.assertIs(top1.moleculetypes['SOL'].atoms, top2.moleculetypes['SOL'].atoms)
+
+        # a changed mtime invalidates the file
+        st = os.stat(spc.filename)
+        os.utime(spc.filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        top3 = TOP(self.topol)
+        self.assertIsNot(TopologyFile.load(spc.filename), spc)
+        self.assertIsNot(top3.moleculetypes['SOL'].atoms, top1.moleculetypes['SOL'].atoms)
+        self.assertIs(top3.moleculetypes['MOL'].atoms, top1.moleculetypes['MOL'].atoms)
+
+    def test_syntax_errors(self):
+        self.write('ff.ff/spc.itp', "[ moleculetype ]\nSOL 2\n#ifdef FLEXIBLE\n")
+        self.assertRaises(SyntaxError, TOP, self.topol)
+        self.write('ff.ff/spc.itp', "[ moleculetype ]\nSOL 2\n#endif\n")
+        self.assertRaises(SyntaxError, TOP, self.topol)
+        self.write('ff.ff/spc.itp', "[ moleculetype ]\nSOL 2\n#if FLEXIBLE\n#endif\n")
+        self.assertRaises(SyntaxError, TOP, self.topol)
+
+
+if __name__ == '__main__':
+    unittest.main()
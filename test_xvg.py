@@ -0,0 +1,173 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from gromacs.fileformats.xvg import Xvg, read_many
+
+
+class SmallIndexXvg(Xvg):
+    index_stride = 4
+
+
+def xvg_text(array, legends=('Potential', 'Kinetic')):
+    header = ['# gmx energy', '@    title "Energies"', '@    xaxis  label "Time (ps)"']
+    header += ['@ s%d legend "%s"' % (i, legend) for i, legend in enumerate(legends)]
+    return "\n".join(header) + "\n" + "".join(" ".join("%.6g" % v for v in row) + "\n" for row in array)
+
+
+class TestXvg(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        t = numpy.arange(50) * 2.0
+        self.array = numpy.column_stack([t, numpy.sin(t), numpy.cos(t) * 10 + 3])
+        lines = xvg_text(self.array).splitlines(True)
+        # comments, set separators and blank lines inside the numeric block
+        lines.insert(12, "# restart\n")
+        lines.insert(20, "&\n")
+        lines.insert(21, "@ s0 legend \"Potential\"\n")
+        lines.insert(30, "\n")
+        lines.insert(31, "   \n")
+        lines.insert(40, "  # indented comment\n")
+        self.filename = self.write('energy.xvg', "".join(lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def assertArrayAlmostEqual(self, a, b):
+        numpy.testing.assert_allclose(numpy.asarray(a), numpy.asarray(b), rtol=1e-5, atol=1e-6)
+
+    def test_read(self):
+        xvg = Xvg(self.filename)
+        self.assertEqual(xvg.array.shape, (50, 3))
+        self.assertArrayAlmostEqual(xvg.array, self.array)
+        self.assertListEqual(xvg.legends, ['Potential', 'Kinetic'])
+        self.assertArrayAlmostEqual(xvg.series('Kinetic'), self.array[:, 2])
+        x, y = xvg.data
+        self.assertArrayAlmostEqual(y, self.array[:, 1])
+
+    def test_lazy_rows_and_window(self):
+        eager = Xvg(self.filename)
+        lazy = SmallIndexXvg(self.filename, lazy=True)
+        self.assertEqual(lazy.nrows, eager.nrows)
+        for start, stop in [(0, 3), (3, 9), (7, 8), (10, 50), (45, None), (-5, None), (20, 20)]:
+            self.assertArrayAlmostEqual(lazy.rows(start, stop), eager.rows(start, stop))
+        for t0, t1 in [(0, 10), (13, 31), (50, 50.5), (90, 1000), (-10, -5)]:
+            self.assertArrayAlmostEqual(lazy.window(t0, t1), eager.window(t0, t1))
+        self.assertIsNone(lazy._array)          # nothing parsed as a whole
+        self.assertEqual(lazy.rows(5, 5).shape, (0, 3))
+        self.assertArrayAlmostEqual(lazy.array, eager.array)
+        lazy.close()
+
+    def test_ragged_rows(self):
+        filename = self.write('ragged.xvg', "# x y\n0 1 2\n1 2\n2 3 4 5\n")
+        self.assertRaises(Exception, Xvg, filename)
+        self.assertRaises(Exception, lambda: SmallIndexXvg(filename, lazy=True).rows(0, 3))
+
+    def test_cache(self):
+        xvg = Xvg(self.filename, cache=True)
+        self.assertTrue(os.path.exists(self.filename + '.cache.npy'))
+        cached = Xvg(self.filename, cache=True)
+        self.assertIsInstance(cached.array, numpy.memmap)
+        self.assertArrayAlmostEqual(cached.array, xvg.array)
+        self.assertListEqual(cached.legends, xvg.legends)
+
+        # a new mtime invalidates the cache
+        with open(self.filename, 'a') as f:
+            f.write("100 1 2\n")
+        changed = Xvg(self.filename, cache=True)
+        self.assertNotIsInstance(changed.array, numpy.memmap)
+        self.assertEqual(changed.nrows, 51)
+        self.assertEqual(Xvg(self.filename, cache=True).nrows, 51)
+
+        # the lazy mode writes the cache when the whole array is parsed
+        os.remove(self.filename + '.cache.npy')
+        lazy = Xvg(self.filename, lazy=True, cache=True)
+        lazy.rows(0, 10)
+        self.assertFalse(os.path.exists(self.filename + '.cache.npy'))
+        self.assertEqual(lazy.array.shape, (51, 3))
+        self.assertIsInstance(Xvg(self.filename, cache=True).array, numpy.memmap)
+
+    def test_follow(self):
+        filename = self.write('live.xvg', "@ s0 legend \"y\"\n0 1\n1 2\n2 3")  # last line is incomplete
+        xvg = Xvg(filename, follow=True)
+        self.assertEqual(xvg.nrows, 2)
+        xvg.scale('y', 10)
+        self.assertArrayAlmostEqual(xvg.y, [10, 20])
+        with open(filename, 'a') as f:
+            f.write("0\n3 4\n4")
+        self.assertEqual(xvg.refresh(), 2)
+        self.assertArrayAlmostEqual(xvg.array, [[0, 10], [1, 20], [2, 300], [3, 40]])
+        self.assertEqual(xvg.refresh(), 0)
+        self.assertRaises(ValueError, Xvg, filename, lazy=True, follow=True)
+
+    def test_write(self):
+        xvg = Xvg(self.filename)
+        for name in ('out.xvg', 'out.xvg.gz'):
+            filename = os.path.join(self.tmpdir, name)
+            xvg.write(filename)
+            copy = Xvg(filename)
+            self.assertArrayAlmostEqual(copy.array, xvg.array)
+            self.assertListEqual(copy.header, xvg.header)
+        with gzip.open(filename, 'rt') as f:
+            self.assertTrue(f.readline().startswith('# gmx energy'))
+        self.assertRaises(ValueError, xvg.write, filename, fmt=['%g', '%g'])
+
+    def test_transforms(self):
+        xvg = Xvg(self.filename)
+        xvg.convert('x', 'ps', 'ns').scale('Potential', 2).shift('Potential', 1)
+        xvg.transform('Kinetic', numpy.negative)
+        self.assertArrayAlmostEqual(xvg.x, self.array[:, 0] / 1000)
+        self.assertArrayAlmostEqual(xvg.series('Potential'), self.array[:, 1] * 2 + 1)
+        self.assertArrayAlmostEqual(xvg.series('Kinetic'), -self.array[:, 2])
+        xvg.alter_y(abs)
+        xvg.alter_x(lambda x: x * 1000, vectorized=True)
+        self.assertArrayAlmostEqual(xvg.y, numpy.abs(self.array[:, 1] * 2 + 1))
+        self.assertArrayAlmostEqual(xvg.x, self.array[:, 0])
+
+    def test_statistics(self):
+        for xvg in (Xvg(self.filename), SmallIndexXvg(self.filename, lazy=True)):
+            stats = xvg.statistics(nblocks=5, chunksize=7)
+            self.assertEqual(stats.n, 50)
+            self.assertArrayAlmostEqual(stats.mean, self.array[:, 1:].mean(axis=0))
+            self.assertArrayAlmostEqual(stats.var, self.array[:, 1:].var(axis=0, ddof=1))
+            self.assertArrayAlmostEqual(stats.min, self.array[:, 1:].min(axis=0))
+            self.assertArrayAlmostEqual(stats.max, self.array[:, 1:].max(axis=0))
+            self.assertArrayAlmostEqual(stats.block_averages, self.array[:, 1:].reshape(5, 10, 2).mean(axis=1))
+
+    def test_decimate(self):
+        eager = Xvg(self.filename)
+        lazy = SmallIndexXvg(self.filename, lazy=True)
+        for method in ('stride', 'mean', 'minmax'):
+            self.assertArrayAlmostEqual(lazy.decimate(10, method), eager.decimate(10, method))
+        self.assertIsNone(lazy._array)
+        self.assertEqual(len(eager.decimate(10, 'lttb')), 10)
+        self.assertEqual(len(eager.decimate(10, 'stride')), 10)
+        self.assertRaises(ValueError, eager.decimate, 10, 'median')
+
+    def test_read_many(self):
+        t = numpy.arange(10.0)
+        files = []
+        for i, (lo, hi) in enumerate([(0, 10), (2, 10), (0, 8)]):
+            files.append(self.write('r%d.xvg' % i, xvg_text(numpy.column_stack([t, t * (i + 1), -t])[lo:hi])))
+        for processes in (1, 2):
+            ensemble = read_many(os.path.join(self.tmpdir, 'r*.xvg'), processes=processes)
+            self.assertListEqual(ensemble.filenames, files)
+            self.assertArrayAlmostEqual(ensemble.x, t[2:8])
+            self.assertEqual(ensemble.stack.shape, (3, 6, 2))
+            self.assertArrayAlmostEqual(ensemble.mean[:, 0], t[2:8] * 2)
+            self.assertArrayAlmostEqual(ensemble.std[:, 1], numpy.zeros(6))
+
+
+if __name__ == '__main__':
+    unittest.main()